@@ -1,5 +1,6 @@
-import logging, re,  sys
+import logging, re,  sys,  threading,  sqlite3,  hashlib,  json,  time
 import importlib
+from pathlib import Path
 # non-std common libraries
 import cv2
 
@@ -9,17 +10,150 @@ from jkm.errors import BarcodeError
 # Dynamic  import in extractbarcodedata to allow for config fig-based import
 CONST_QREADER = "qreader"
 CONST_PYZBAR = "pyzbar"
+CONST_OPENCV = "opencv"
 pyzbar = QReader = None
+qreader_settings = {"model_size": "l", "min_confidence": 0.05} # See configure()
+_qreader = None # QReader model of this process, loaded once by load_backend
+_qreader_lock = threading.Lock() # The model is shared by the worker threads of a process
+scale_ladder = (200,600,2000,None) # Image sizes (longer side, None = full resolution) tried by pyzbar, smallest first
+scale_stats = None # ScaleStats reordering scale_ladder per station, None = fixed ladder
+locate_maxdim = 0 # If set, pyzbar decodes QR codes located at this resolution instead of the whole full resolution image
+barcode_cache = None # BarcodeCache of this process, see configure_cache()
+
+_sampleid_re = re.compile("([A-Z0-9]+.[0-9-]+)",re.IGNORECASE) # Short identifier, see sampleids
 
 log = logging.getLogger() # Overwrite if needed
 
-def _extract_pyzbar(greyimg, encoding=None):
+def configure(model_size="l", min_confidence=0.05):
+    "Set the QReader model size (n, s, m or l) and minimum detection confidence, the model is reloaded if they change"
+    global _qreader
+    settings = {"model_size": model_size, "min_confidence": min_confidence}
+    if settings != qreader_settings: _qreader = None
+    qreader_settings.update(settings)
+
+class ScaleStats():
+    """Barcode decoding attempts and successes per station (e.g. camera) and image size of the scale ladder.
+
+Once a station has min_samples samples, the sizes giving at least min_share of its barcodes are tried first, most 
+successful first, and the rest of the ladder only if they fail. Hit rates are logged every log_every samples."""
+    def __init__(self, min_samples=20, min_share=0.05, log_every=100):
+        self.min_samples = min_samples
+        self.min_share = min_share
+        self.log_every = log_every
+        self._stats = {} # station: {"samples": n, "attempts": {maxdim: n}, "hits": {maxdim: n}}
+        self._lock = threading.Lock()
+    def ladder(self, station):
+        "The sizes to try, in order"
+        with self._lock:
+            s = self._stats.get(station)
+            if not s or s["samples"] < self.min_samples: return list(scale_ladder)
+            preferred = sorted((m for m in scale_ladder if s["hits"].get(m, 0) >= self.min_share*s["samples"]), key=lambda m: -s["hits"][m])
+        return preferred + [m for m in scale_ladder if m not in preferred] # Fall back to the full ladder
+    def record(self, station, tried, found):
+        "Add one sample: the sizes tried, in order, and whether the last one gave barcodes"
+        with self._lock:
+            s = self._stats.setdefault(station, {"samples": 0, "attempts": {}, "hits": {}})
+            s["samples"] += 1
+            for m in tried: s["attempts"][m] = s["attempts"].get(m, 0) + 1
+            if found: s["hits"][tried[-1]] = s["hits"].get(tried[-1], 0) + 1
+            report = self.log_every and s["samples"] % self.log_every == 0
+        if report: log.info(f"Barcode scale hit rates for {station}: {self.hitrates(station)}")
+    def hitrates(self, station):
+        "size: (hits, attempts) of a station"
+        with self._lock:
+            s = self._stats.get(station, {"attempts": {}, "hits": {}})
+            return {m or "full": (s["hits"].get(m, 0), n) for m, n in s["attempts"].items()}
+
+class BarcodeCache():
+    """Decoded barcodes keyed by a content hash of the image file and the decoding parameters, see cache_key.
+
+A SQLite database, which can be shared by the worker processes. Safe to use from several threads of one process."""
+    def __init__(self, dbfile):
+        self.dbfile = Path(dbfile)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.dbfile), timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL") # Readers are not blocked by the other processes writing
+        self._db.execute("""CREATE TABLE IF NOT EXISTS barcodes (
+            key TEXT PRIMARY KEY, data TEXT, backend TEXT, updated REAL)""")
+        self._db.commit()
+        log.debug(f"Using barcode cache {self.dbfile}")
+    def get(self, key):
+        "Returns (decoded strings, backend name) stored with key, None if not in the cache"
+        with self._lock: row = self._db.execute("SELECT data, backend FROM barcodes WHERE key = ?", (key,)).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+    def put(self, key, data, backend):
+        "Store decoded strings (not bytes) and the name of the backend that decoded them"
+        try: data = json.dumps(data)
+        except TypeError: return # Not decoded to text
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO barcodes VALUES (?, ?, ?, ?)", (key, data, backend, time.time()))
+            self._db.commit()
+    def close(self):
+        with self._lock: self._db.close()
+
+def content_hash(source):
+    "BLAKE2b hash of the contents of an image file, given as a path or as the file contents (bytes-like)"
+    h = hashlib.blake2b(digest_size=20)
+    if isinstance(source, (str, Path)):
+        with open(source, "rb") as f:
+            for chunk in iter(lambda: f.read(2**20), b""): h.update(chunk)
+    else: h.update(source)
+    return h.hexdigest()
+
+def cache_key(source, qrpackage, increasecontast=False, greyrange=50, encoding=None):
+    "Barcode cache key: the image file contents and every setting that can change the decoded barcodes"
+    params = [backends(qrpackage), bool(increasecontast), greyrange if increasecontast else None, encoding, locate_maxdim, 
+              qreader_settings if CONST_QREADER in backends(qrpackage) else None]
+    return content_hash(source) + hashlib.blake2b(json.dumps(params, sort_keys=True).encode("utf8"), digest_size=8).hexdigest()
+
+def configure_cache(dbfile=None):
+    "Use the barcode cache database dbfile in this process, no caching if not given"
+    global barcode_cache
+    if barcode_cache: barcode_cache.close()
+    barcode_cache = BarcodeCache(dbfile) if dbfile else None
+
+def _decode_pyzbar(img): return pyzbar.decode(img, symbols=[pyzbar.ZBarSymbol.QRCODE])
+
+def _decode_located(get_level, maxdim, pad=0.5):
+    """Find QR code candidates with cv2.QRCodeDetector at resolution maxdim, then decode only the candidate areas,
+padded by pad times their size, at full resolution"""
+    smallimg = get_level(maxdim)
+    found, points = cv2.QRCodeDetector().detectMulti(smallimg)
+    if not found or points is None: return []
+    fullimg = get_level(None)
+    scale = max(fullimg.shape[:2])/max(smallimg.shape[:2])
+    log.debug(f"Decoding {len(points)} QR code candidate area(s) at full resolution")
     barcodes = []
+    for quad in points:
+        (x1, y1), (x2, y2) = quad.min(axis=0)*scale, quad.max(axis=0)*scale
+        p = pad*max(x2-x1, y2-y1) + 10
+        barcodes += _decode_pyzbar(fullimg[max(0, int(y1-p)):int(y2+p), max(0, int(x1-p)):int(x2+p)])
+    return barcodes
+
+def _extract_pyzbar(greyimg, encoding=None, get_level=None, station=None, info=None):
+    """get_level(maxdim) returns the image scaled to maxdim (None = full size), by default made from greyimg.
+
+If locate_maxdim is set, the full resolution image is not decoded as a whole but only where QR codes are located.
+The sizes are tried in the order given by scale_stats for station, if set. The sizes tried and the one giving 
+barcodes (if any) are stored in info["scales"] and info["scale"] (missing if none did)."""
+    barcodes = []
+    get_level = get_level or (lambda maxdim: greyimg if maxdim is None else tools.shrink_to_maxdim(greyimg,maxdim))
+    tried, full_tried = [], False
     # try qr recognition at different image sizes
-    for maxdim in (200,600,2000,max(greyimg.shape)):
-        smallimg = tools.shrink_to_maxdim(greyimg,maxdim)
-        barcodes = pyzbar.decode(smallimg, symbols=[pyzbar.ZBarSymbol.QRCODE])
-        if barcodes or maxdim == max(greyimg.shape): break
+    for maxdim in scale_stats.ladder(station) if scale_stats else scale_ladder:
+        if maxdim is None and locate_maxdim: barcodes = _decode_located(get_level, locate_maxdim)
+        else:
+            smallimg = get_level(maxdim)
+            is_full = maxdim is None or max(smallimg.shape) < maxdim
+            if is_full and full_tried: continue # Larger sizes are the same full size image
+            full_tried = full_tried or is_full
+            barcodes = _decode_pyzbar(smallimg)
+        tried.append(maxdim)
+        if barcodes: break
+    if scale_stats: scale_stats.record(station, tried, bool(barcodes))
+    if info is not None:
+        info["scales"] = tried
+        if barcodes: info["scale"] = tried[-1]
     log.debug("Found %i barcode(s)" % len(barcodes))
     d = []
     for qr in barcodes:
@@ -28,49 +162,128 @@ def _extract_pyzbar(greyimg, encoding=None):
         d.append(bkd)
     return [x for x in d if x] # Make sure the result is a list of non-empty string
 
+def _qreader_model():
+    "The QReader instance of this process, the YOLO weights are loaded only on the first call"
+    global _qreader
+    if _qreader is None:
+        log.debug(f"Loading QReader model {qreader_settings}")
+        _qreader = QReader(**qreader_settings)
+    return _qreader
+
 def _extract_qreader(greyimg):
+    return _extract_qreader_batch([greyimg])[0]
+
+def _extract_qreader_batch(greyimgs):
+    "QReader decodes one image per call, but the model is loaded once and locked once for the whole batch"
     try:
-        qreader = QReader( model_size='l',min_confidence=0.05 )
-        decoded_text = qreader.detect_and_decode(image=greyimg)
-        # Make sure the result is a list of non-empty strings (removes None values and empty strings)
-        d = [x for x in decoded_text if x] # Make sure the result is a list of non-empty string
+        with _qreader_lock:
+            model = _qreader_model()
+            decoded = [model.detect_and_decode(image=img) for img in greyimgs]
     except ModuleNotFoundError as msg:
         # qreader install on my computer lacks the ultralytics.yolo package
         log.warning(msg)
-        d = []
+        return [[] for img in greyimgs]
+    # Make sure the results are lists of non-empty strings (removes None values and empty strings)
+    return [[x for x in decoded_text if x] for decoded_text in decoded]
+
+def _extract_opencv(get_level):
+    "OpenCV's own QR code reader (the ArUco based one if available), at growing image sizes like _extract_pyzbar"
+    detector = cv2.QRCodeDetectorAruco() if hasattr(cv2, "QRCodeDetectorAruco") else cv2.QRCodeDetector()
+    d = []
+    for maxdim in (600,2000,None):
+        smallimg = get_level(maxdim)
+        found, decoded_text, points, straight = detector.detectAndDecodeMulti(smallimg)
+        d = [x for x in decoded_text if x] if found else []
+        if d or maxdim is None or max(smallimg.shape) < maxdim: break # Found, or already at full size
     return d
-    
+
+# Backend name: function(get_level, encoding, station, info) returning a list of decoded strings
+_extractors = {CONST_PYZBAR: lambda get_level, encoding, station, info: _extract_pyzbar(None, encoding, get_level, station, info),
+               CONST_OPENCV: lambda get_level, encoding, station, info: _extract_opencv(get_level),
+               CONST_QREADER: lambda get_level, encoding, station, info: _extract_qreader(get_level(None))}
+
+def backends(qrpackage):
+    "Backend names in a barcodepackage setting: one name, or a comma separated cascade tried in order, e.g. 'pyzbar, opencv, qreader'"
+    return [x.strip() for x in qrpackage.lower().split(",") if x.strip()]
+
+def load_backend(qrpackage):
+    "Import the barcode reader package(s) once (per process)"
+    global QReader, pyzbar
+    for name in backends(qrpackage):
+        if name not in _extractors:
+            log.critical(f"Unknown barcode reader tool '{name}'")
+            sys.exit()
+        if name == CONST_PYZBAR and not pyzbar:
+            pyzbar = importlib.import_module("pyzbar.pyzbar")
+        elif name == CONST_QREADER and not QReader:
+            QReader = importlib.import_module("qreader").QReader
+        if name == CONST_QREADER:
+            try:
+                with _qreader_lock: _qreader_model()
+            except ModuleNotFoundError as msg: log.warning(msg) # Reported again when decoding
+
 def extractbarcodedata(image, qrpackage, increasecontast=False,
-                       greyrange=50,  encoding=None):
+                       greyrange=50,  encoding=None, pyramid=None, info=None, station=None, source=None):
     "Is decite is not None, it is assumed to be a name for the enconding used in decoding the barcode byte stream to text"
 
     "Accepts either a filename, a file object, opencv images. Should also work with PIL or nympy image arrays."
-    global QReader, pyzbar
-    if qrpackage not in (CONST_QREADER, CONST_PYZBAR):
-        log.critical(f"Unknown barcode reader tool '{qrpackage}'")
-        sys.exit()
-    img = tools.load_img(image)
-    greyimg = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    if increasecontast: greyimg = tools.increaseTopContrast(greyimg,greyrange)
-    if qrpackage == CONST_PYZBAR:
-        if not pyzbar: 
-            importlib.import_module("pyzbar")
-            from pyzbar import pyzbar
-        d = _extract_pyzbar(greyimg, encoding)    
-    elif qrpackage == CONST_QREADER:
-        if not QReader: 
-            QReader = importlib.import_module("qreader").QReader
-        d = _extract_qreader(greyimg)
-    # else: should not happen as tested above
+    "If pyramid (a jkm.pyramid.ImagePyramid) is given, image is not used: downscaled images are taken from the pyramid."
+    "With several backends (see backends), the next one is tried only if no sample identifier was found."
+    "The name of the backend giving the result is stored in info['backend'], if info (a dict) is given."
+    "station (e.g. the camera) selects the decoding statistics used by scale_stats."
+    "source (the image file path or contents) enables the barcode cache: barcodes already decoded from the same file are not decoded again."
+    info = {} if info is None else info
+    key = None
+    if barcode_cache and source is not None:
+        try: key = cache_key(source, qrpackage, increasecontast, greyrange, encoding)
+        except OSError as msg: log.debug(f"Cannot hash image file for the barcode cache: {msg}")
+        cached = barcode_cache.get(key) if key else None
+        if cached:
+            log.debug(f"Barcodes from the barcode cache: {cached[0]}")
+            info.update(backend=cached[1], cached=True)
+            return cached[0]
+    load_backend(qrpackage)
+    if pyramid is None:
+        img = tools.load_img(image)
+        greyimg = tools.to_grey(img)
+        if increasecontast: greyimg = tools.increaseTopContrast(greyimg,greyrange)
+        get_level = lambda maxdim: greyimg if maxdim is None else tools.shrink_to_maxdim(greyimg,maxdim)
+    else:
+        get_level = lambda maxdim: pyramid.level(maxdim, grayscale=True)[0]
+        if increasecontast: # Shared by all backends and passes through the image cache
+            get_level = lambda maxdim, f=get_level: pyramid.image.view(("level", maxdim, "grey", "contrast", greyrange),
+                                                                     lambda: tools.increaseTopContrast(f(maxdim),greyrange))
+    d, used = [], None
+    for name in backends(qrpackage):
+        found = _extractors[name](get_level, encoding, station, info)
+        if found and not d: d, used = found, name # Kept if no backend finds an identifier
+        if found and has_sampleid(found):
+            d, used = found, name
+            break
+        if found: log.debug(f"No sample identifier in barcodes read by {name}: {found}")
+    if used: log.debug(f"Barcodes read by {used}")
+    info["backend"] = used
+    if key: barcode_cache.put(key, d, used)
     return d
 
+def decode_batch(greyimgs, qrpackage, encoding=None):
+    "Decode barcodes in several greyscale images in one call, returns a list of decoded strings per image (first backend only)"
+    load_backend(qrpackage)
+    name = backends(qrpackage)[0]
+    if name == CONST_QREADER: return _extract_qreader_batch(greyimgs)
+    return [_extractors[name](lambda maxdim, img=img: img if maxdim is None else tools.shrink_to_maxdim(img,maxdim), encoding, None, None) for img in greyimgs]
+
+def has_sampleid(data):
+    "True if any of the decoded strings contains a sample identifier (see sampleids)"
+    return any(_sampleid_re.search(x.decode(errors="ignore") if isinstance(x, bytes) else x) for x in data)
+
 def sampleids(data):
     # Add CETAF verification here too...
     # read: a list of strings
     # return a list of (namespace,id) tuples of all detected labels
     sids = []
     reg1 = re.compile("/([A-Z0-9]+.[0-9-]+)",re.IGNORECASE)
-    reg2 = re.compile("([A-Z0-9]+.[0-9-]+)",re.IGNORECASE)
+    reg2 = _sampleid_re
     log.debug("Trying to find CETAF Identifiers in %s" % data)
     for l in data:
         m = reg1.search(l)
@@ -14,10 +14,14 @@ import cv2
 import numpy as np
 #import matplotlib.pyplot as plt
 import jkm.tools as tools
+import jkm.tiledreader,  jkm.derivatives
 #import detect_ruler as dr
 #import cProfile
 
 def get_edge(img,width=100,edge=0): # Get a slice along an edge (0=bottom)
+    if isinstance(img, jkm.tiledreader.WindowReader): # Read only the edge of a large image
+        w, h = img.size
+        return img.read((0, h-width, w, h-1))
     return img[-width:-1,:]
 
 def split_edge(img,n_parts = 10): # Returns the edge in 10 parts
@@ -49,17 +53,22 @@ def extract_pixels_per_ruler_unit(img,optimize=False):
     """Assumes rules near edge and ticks perpendicular to edge!
 
     Returns a list of pix-per-ruler estimates (potentially with float values!).
+    img can also be a jkm.tiledreader.WindowReader, then only the edge of the image is read.
 
     You can use optimize_ppu() to convert the list to a single value.
     """
-    # Resize,  greyscale
-    fx = fy = 1
-    img_gr = cv2.resize(img,(0,0),fx=fx,fy=fy)
-    img_gr = cv2.cvtColor(img_gr,cv2.COLOR_RGB2GRAY)
-    edge_width = int(max(img_gr.shape)/10)
-    # Find edges
-    # Currently gets only one edge (=lower edge)
-    edge = get_edge(img_gr, edge_width, 0)
+    if isinstance(img, jkm.tiledreader.WindowReader): # Large image: read and convert only the edge
+        edge_width = int(max(img.size)/10)
+        edge = tools.to_grey(get_edge(img, edge_width, 0))
+    else:
+        # Resize,  greyscale
+        fx = fy = 1
+        img_gr = cv2.resize(img,(0,0),fx=fx,fy=fy)
+        img_gr = cv2.cvtColor(img_gr,cv2.COLOR_RGB2GRAY)
+        edge_width = int(max(img_gr.shape)/10)
+        # Find edges
+        # Currently gets only one edge (=lower edge)
+        edge = get_edge(img_gr, edge_width, 0)
     values = []
     for sect in split_edge(edge)[1:-1:2]: # Every second element long this edge, except end elements       
 #        sectb = cv2.GaussianBlur(sect, (11,11), 10) 
@@ -120,7 +129,8 @@ def mainfunc():
     else:
         ppu = optimize_ppu(x)
         outimg = draw_scalebar(img,ppu,print_text="cm")    
-        cv2.imwrite(r"testout.jpg",outimg)
+        jkm.derivatives.save(r"testout.jpg",outimg)
+        jkm.derivatives.close()
 
 if __name__ == '__main__':
     mainfunc()
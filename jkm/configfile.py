@@ -10,6 +10,7 @@ class Multicamconfig():
 # TODO: write support    
     def __init__(self, fn=None):
         self._c = configparser.ConfigParser(interpolation=None)
+        self.filename = None # Path of the loaded file, used e.g. to reload the configuration in worker processes
         if fn: self.loadfile(fn)
         self.monitor = False
     def loadfile(self,fn, encoding="utf8"):
@@ -18,6 +19,7 @@ class Multicamconfig():
             with fnp.open(encoding=encoding) as f:
                 self._c = configparser.ConfigParser(interpolation=None)
                 self._c.read_file(f)
+            self.filename = fnp
     def get(self,*args,**kwargs): 
         try: return self._c.get(*args, **kwargs)
         except configparser.Error as msg: raise errors.LoggingError(msg, level = logging.CRITICAL) 
@@ -27,6 +29,8 @@ class Multicamconfig():
     def getlist(self,*args,**kwargs):
         return tools.string2list(self._c.get(*args, **kwargs))
     def has_section(self, section): return self._c.has_section(section)
+    def items(self, section): return self._c.items(section)
+    def has_option(self, section, option): return self._c.has_option(section, option)
     def sections(self): return self._c.sections()
     @property
     def basepath(self): return Path(self._c.get("basic","main_data_directory"))  # TODO: Should we create if not_exists()    
@@ -40,6 +44,9 @@ def parse_args(programname): # Get command-line arguments, if any
             required = True,
             help = 'name of configuration life',
             type=Path)
+    parser.add_argument('--reprocess',          
+            action = 'store_true',
+            help = 'process all samples again, ignoring the processing ledger')
     return parser.parse_args()
 
 def load_configuration(programname):
@@ -50,6 +57,7 @@ def load_configuration(programname):
         conf_fn = cmdargs.config_file
         log.info(f"Reading configuration file {conf_fn}")
         m = Multicamconfig(conf_fn)
+        m.args = cmdargs
         return m
     except Exception as err:
         log.critical(f"Loading configuration file {conf_fn} failed: {err}")
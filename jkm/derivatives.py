@@ -0,0 +1,73 @@
+"""
+Asynchronous writing of derived images: text area crops, rotated images, scale bar images etc.
+
+Images are encoded and written by a pool of writer threads fed from a bounded queue, so that slow JPEG
+encoding and slow network shares do not hold up the processing workers. Queued images are always
+written before the program (or a worker process) exits.
+"""
+import logging,  threading,  queue,  atexit
+from pathlib import Path
+import cv2
+import numpy as np
+
+log = logging.getLogger() # Overwrite if needed
+_STOP = object() # End-of-life marker for writer threads
+
+class DerivativeWriter():
+    """Writes images with cv2.imwrite in threads writer threads (0 = write immediately in the calling thread).
+
+save() blocks while maxsize images are waiting. params: extension: list of cv2.imwrite parameters, e.g. {".jpg": [cv2.IMWRITE_JPEG_QUALITY, 90]}"""
+    def __init__(self, threads=2, maxsize=16, params=None):
+        self.params = params or {}
+        self.written = self.failed = 0
+        self._queue = queue.Queue(maxsize=max(1, maxsize))
+        self._threads = [threading.Thread(target=self._run, name=f"writer-{n}", daemon=True) for n in range(threads)]
+        for t in self._threads: t.start()
+    def save(self, fn, image, params=None):
+        "Queue an image to be written to file fn. params override the parameters for the file type."
+        image = np.ascontiguousarray(image) # Copies crops, so that they do not keep the whole source image in memory
+        if params is None: params = self.params.get(Path(fn).suffix.lower(), [])
+        if self._threads: self._queue.put((Path(fn), image, params))
+        else: self._write(Path(fn), image, params)
+    def flush(self):
+        "Wait until all queued images have been written"
+        if self._threads: self._queue.join()
+    def close(self):
+        "Write queued images and stop the writer threads"
+        for t in self._threads: self._queue.put(_STOP)
+        for t in self._threads: t.join()
+        self._threads = []
+    def _write(self, fn, image, params):
+        try:
+            if not cv2.imwrite(str(fn), image, params): raise OSError("cv2.imwrite returned False")
+            self.written += 1
+            log.debug(f"Wrote {fn}")
+        except (OSError, cv2.error) as msg:
+            self.failed += 1
+            log.warning(f"Writing image {fn} failed: {msg}")
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP: break
+                self._write(*item)
+            finally: self._queue.task_done()
+
+writer = DerivativeWriter(threads=0) # Writer of this process, see configure()
+
+def encode_params(jpeg_quality=95, png_compression=3):
+    "cv2.imwrite parameters per file type"
+    jpeg = [cv2.IMWRITE_JPEG_QUALITY, int(jpeg_quality)]
+    return {".jpg": jpeg, ".jpeg": jpeg, ".png": [cv2.IMWRITE_PNG_COMPRESSION, int(png_compression)]}
+
+def configure(threads=2, maxsize=16, jpeg_quality=95, png_compression=3):
+    "Replace the writer of this process, writing images queued to the old one first"
+    global writer
+    old, writer = writer, DerivativeWriter(threads, maxsize, encode_params(jpeg_quality, png_compression))
+    old.close()
+
+def save(fn, image, params=None): writer.save(fn, image, params)
+def flush(): writer.flush()
+def close(): writer.close()
+
+atexit.register(lambda: writer.close()) # Also in worker processes, which exit without calling close()
@@ -0,0 +1,70 @@
+"""
+Shared in-memory store for decoded images and views derived from them.
+
+Images are keyed by (owner, view), e.g. (image id, "full"), (image id, 4, "grey") or (image id, "crop", rect, "gamma3"),
+so that a greyscale, downscaled or contrast-enhanced version is computed once and shared by all postprocessing stages.
+The least recently used images are dropped when the total size exceeds a byte budget. Each process has its own cache.
+"""
+import logging,  threading,  itertools
+from collections import OrderedDict
+
+log = logging.getLogger() # Overwrite if needed
+
+class ImageCache():
+    "Thread-safe LRU cache of image arrays with a total size limit in bytes (0 = no caching)"
+    def __init__(self, max_bytes=512*2**20):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = self.misses = 0
+        self._items = OrderedDict() # key: image array
+        self._lock = threading.Lock()
+    def get(self, key):
+        "Returns the image stored with key, None if not in the cache"
+        with self._lock:
+            img = self._items.get(key)
+            if img is not None: self._items.move_to_end(key)
+            return img
+    def put(self, key, img):
+        "Store an image, dropping least recently used ones if needed. Images larger than the budget are not stored."
+        size = getattr(img, "nbytes", 0)
+        with self._lock:
+            if key in self._items: self.nbytes -= self._items.pop(key).nbytes
+            if size > self.max_bytes:
+                if self.max_bytes: log.debug(f"Image {key} ({size/2**20:.1f} MB) does not fit in the image cache")
+                return
+            self._items[key] = img
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                oldkey, old = self._items.popitem(last=False)
+                self.nbytes -= old.nbytes
+                log.debug(f"Dropped image {oldkey} from the image cache")
+    def get_or_create(self, key, make):
+        "Returns the image stored with key, or calls make() to create it and stores the result"
+        img = self.get(key)
+        if img is not None:
+            self.hits += 1
+            return img
+        self.misses += 1
+        img = make() # Not under the lock: several threads may create the same image, the last one is stored
+        self.put(key, img)
+        return img
+    def discard(self, owner):
+        "Drop all images of an owner, i.e. all keys starting with owner"
+        with self._lock:
+            for key in [k for k in self._items if k[0] == owner]: self.nbytes -= self._items.pop(key).nbytes
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+cache = ImageCache() # Cache of this process
+_owner_ids = itertools.count(1)
+
+def new_owner():
+    "Unique id for an object storing images in the cache"
+    return next(_owner_ids)
+
+def configure(max_mb):
+    "Set the size limit of the cache of this process (megabytes)"
+    cache.max_bytes = int(max_mb*2**20)
+    log.debug(f"Image cache size limit {max_mb} MB")
@@ -0,0 +1,64 @@
+"""
+Persistent processing ledger: a local SQLite database of samples already postprocessed.
+
+Samples are keyed by data file path, size, modification time and a hash of the configuration,
+so that a restart with process_existing processes only new or changed samples.
+"""
+import logging,  sqlite3,  threading,  hashlib,  json,  os,  time
+from pathlib import Path
+
+log = logging.getLogger() # Overwrite if needed
+
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_POISONED = "poisoned" # Crashed or hung a worker process, not retried unless reprocessing
+
+def config_hash(conf, sections, exclude=()):
+    "Hash of the given configuration sections, ignoring keys in exclude"
+    h = hashlib.sha1()
+    for section in sections:
+        if not conf.has_section(section): continue
+        for k, v in sorted(conf.items(section)):
+            if k not in exclude: h.update(f"[{section}]{k}={v}\n".encode("utf8"))
+    return h.hexdigest()
+
+def file_signature(path):
+    "Returns (size, mtime in ns) of a file, or None if it cannot be accessed"
+    try:
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime_ns)
+    except OSError: return None
+
+class ProcessingLedger():
+    "Per-sample processing status and results. Safe to use from several threads of one process."
+    def __init__(self, dbfile, confhash):
+        self.dbfile = Path(dbfile)
+        self.confhash = confhash
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.dbfile), check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS samples (
+            path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, confhash TEXT,
+            status TEXT, result TEXT, updated REAL)""")
+        self._db.commit()
+        log.info(f"Using processing ledger {self.dbfile}")
+    def is_done(self, path, signature=None, statuses=(STATUS_DONE,)):
+        "True if the sample was processed (with a status in statuses) with the same file size, mtime and configuration"
+        signature = signature or file_signature(path)
+        if signature is None: return False
+        with self._lock:
+            row = self._db.execute("SELECT size, mtime_ns, confhash, status FROM samples WHERE path = ?",
+                                   (str(Path(path)),)).fetchone()
+        return row is not None and tuple(row[:3]) == (signature[0], signature[1], self.confhash) and row[3] in statuses
+    def status(self, path):
+        with self._lock:
+            row = self._db.execute("SELECT status FROM samples WHERE path = ?", (str(Path(path)),)).fetchone()
+        return row[0] if row else None
+    def record(self, path, status, result=None):
+        "Store status (and a JSON serialisable result dict) for the sample with data file path"
+        signature = file_signature(path) or (None, None)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (str(Path(path)), signature[0], signature[1], self.confhash, status, json.dumps(result or {}), time.time()))
+            self._db.commit()
+    def close(self):
+        with self._lock: self._db.close()
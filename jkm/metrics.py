@@ -0,0 +1,166 @@
+"""
+Counters and latency histograms for the postprocessor stages.
+
+Durations are collected per sample (picklable, so that they can be returned from worker processes)
+and added to a MetricsRegistry in the main process. The registry is written regularly to a
+Prometheus text file (e.g. for the node_exporter textfile collector) and a JSON stats file.
+"""
+import logging,  threading,  time,  json,  os,  contextlib
+from collections import deque
+from pathlib import Path
+
+log = logging.getLogger() # Overwrite if needed
+
+buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # Histogram upper bounds in seconds
+_prefix = "jkm_post"
+rate_windows = (1, 5, 15) # Minutes
+
+@contextlib.contextmanager
+def timed(timings, name):
+    "Add the time spent in the with block to timings[name] (seconds)"
+    t0 = time.perf_counter()
+    try: yield
+    finally: timings[name] = timings.get(name, 0.0) + time.perf_counter() - t0
+
+def count(counts, name, n=1, **labels):
+    "Add n to the event counter name with the given labels in the dict counts (e.g. SampleResult.counts)"
+    key = (name,) + tuple(sorted((k, str(v)) for k, v in labels.items()))
+    counts[key] = counts.get(key, 0) + n
+
+class Histogram():
+    def __init__(self):
+        self.counts = [0]*(len(buckets)+1) # Last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+    def observe(self, value):
+        i = next((i for i, b in enumerate(buckets) if value <= b), len(buckets))
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+    def cumulative(self):
+        total, out = 0, []
+        for c in self.counts:
+            total += c
+            out.append(total)
+        return out
+
+def percentile(sortedvalues, p):
+    "Nearest-rank percentile (p in 0-100) of a sorted list"
+    if not sortedvalues: return None
+    return sortedvalues[min(len(sortedvalues)-1, int(p/100*len(sortedvalues)))]
+
+class MetricsRegistry():
+    """Thread-safe sample counters and per-stage latency histograms.
+
+Also keeps the most recent durations per stage (for percentiles) and completion times of the
+last 15 minutes (for throughput). Rates are 0 until min_elapsed seconds have passed since start-up."""
+    def __init__(self, recent=1000, min_elapsed=15.0):
+        self.started = time.time()
+        self.min_elapsed = min_elapsed
+        self._t0 = time.monotonic()
+        self._lock = threading.Lock()
+        self._counters = {} # status: count
+        self._counts = {} # Other events, (name, (label, value)...): count, see count()
+        self._stages = {} # stage name: Histogram
+        self._recent = {} # stage name: deque of the latest durations
+        self._recentlen = recent
+        self._completed = deque() # time.monotonic() of completed samples within the longest rate window
+    def add_sample(self, timings, status="done", counts=None):
+        "Add the stage timings and event counts of one sample"
+        now = time.monotonic()
+        with self._lock:
+            self._counters[status] = self._counters.get(status, 0) + 1
+            for key, n in (counts or {}).items(): self._counts[key] = self._counts.get(key, 0) + n
+            for name, seconds in timings.items():
+                self._stages.setdefault(name, Histogram()).observe(seconds)
+                self._recent.setdefault(name, deque(maxlen=self._recentlen)).append(seconds)
+            self._completed.append(now)
+            self._expire(now)
+    def _expire(self, now):
+        while self._completed and now - self._completed[0] > 60*max(rate_windows): self._completed.popleft()
+    def rates(self):
+        "Samples per second over the last 1, 5 and 15 minutes"
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            times = list(self._completed)
+        elapsed = now - self._t0
+        if elapsed < self.min_elapsed: return {f"{m}min": 0.0 for m in rate_windows} # Too short to be meaningful
+        window = lambda m: min(60*m, elapsed) # Shorter at start-up
+        return {f"{m}min": round(sum(1 for t in times if now - t <= 60*m)/window(m), 4) for m in rate_windows}
+    def latencies(self):
+        "p50/p95/p99 of the most recent durations per stage"
+        with self._lock: recent = {name: sorted(d) for name, d in self._recent.items()}
+        return {name: {f"p{p}": percentile(v, p) for p in (50, 95, 99)} for name, v in recent.items()}
+    def as_dict(self):
+        latencies = self.latencies()
+        rates = self.rates()
+        with self._lock:
+            stages = {name: {"count": h.count, "sum_s": round(h.sum, 4), "mean_s": round(h.sum/h.count, 4) if h.count else 0.0,
+                             **latencies.get(name, {})} for name, h in self._stages.items()}
+            counts = {}
+            for (name, *labels), n in sorted(self._counts.items()): counts.setdefault(name, {})[",".join(f"{k}={v}" for k, v in labels)] = n
+            return {"timestamp": time.time(), "uptime_s": round(time.time() - self.started, 1),
+                    "samples": dict(self._counters), "samples_per_s": rates, "stages": stages, "counts": counts}
+    def as_prometheus(self):
+        lines = [f"# HELP {_prefix}_samples_total Samples handled by the postprocessor",
+                 f"# TYPE {_prefix}_samples_total counter"]
+        with self._lock:
+            for status, n in sorted(self._counters.items()):
+                lines.append(f'{_prefix}_samples_total{{status="{status}"}} {n}')
+            lines += [f"# HELP {_prefix}_stage_seconds Time spent per sample in each postprocessing stage",
+                      f"# TYPE {_prefix}_stage_seconds histogram"]
+            for name, h in sorted(self._stages.items()):
+                for le, n in zip([str(b) for b in buckets] + ["+Inf"], h.cumulative()):
+                    lines.append(f'{_prefix}_stage_seconds_bucket{{stage="{name}",le="{le}"}} {n}')
+                lines.append(f'{_prefix}_stage_seconds_sum{{stage="{name}"}} {h.sum}')
+                lines.append(f'{_prefix}_stage_seconds_count{{stage="{name}"}} {h.count}')
+            typed = set()
+            for (name, *labels), n in sorted(self._counts.items()):
+                if name not in typed: lines.append(f"# TYPE {_prefix}_{name}_total counter")
+                typed.add(name)
+                labelstr = ",".join('%s="%s"' % kv for kv in labels)
+                lines.append(f"{_prefix}_{name}_total{{{labelstr}}} {n}")
+        return "\n".join(lines) + "\n"
+
+class RecentErrorsHandler(logging.Handler):
+    "Logging handler keeping the latest warnings and errors in memory"
+    def __init__(self, maxlen=50, level=logging.WARNING):
+        super().__init__(level)
+        self.records = deque(maxlen=maxlen)
+    def emit(self, record):
+        try: self.records.append({"time": record.created, "level": record.levelname, "message": record.getMessage()})
+        except Exception: self.handleError(record)
+    def recent(self): return list(self.records)
+
+def _write_atomic(fn, text):
+    "Write via a temporary file, so that readers never see a partially written file"
+    fn = Path(fn)
+    tmp = fn.with_name(fn.name + ".tmp")
+    with tmp.open("w", encoding="utf8") as f: f.write(text)
+    os.replace(tmp, fn)
+
+class MetricsWriter():
+    "Write the registry every interval seconds to a Prometheus text file and/or a JSON stats file"
+    def __init__(self, registry, prometheus_file=None, json_file=None, interval=15.0):
+        self.registry = registry
+        self.prometheus_file = prometheus_file
+        self.json_file = json_file
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+    def write(self):
+        try:
+            if self.prometheus_file: _write_atomic(self.prometheus_file, self.registry.as_prometheus())
+            if self.json_file: _write_atomic(self.json_file, json.dumps(self.registry.as_dict(), indent=2))
+        except OSError as msg: log.warning(f"Writing metrics failed: {msg}")
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="metrics", daemon=True)
+        self._thread.start()
+    def stop(self):
+        "Stop and write the final values"
+        self._stop.set()
+        if self._thread: self._thread.join()
+        self.write()
+    def _run(self):
+        while not self._stop.wait(self.interval): self.write()
@@ -4,10 +4,10 @@ import numpy as np
 import cv2
 import jkm.tools
 #from pathlib import Path
-import time, sys
+import time, sys, threading
 
 log = logging.getLogger() # Overwrite if needed
-_net = None
+_nets = threading.local() # One EAST net per thread, cv2.dnn nets are not safe for concurrent use
 
 # DEFAULT SETUP
 #pytesseract.pytesseract.tesseract_cmd = None
@@ -30,6 +30,10 @@ def _load_neural_net(fn):
         sys.exit()
     return net
 
+def load_neural_net(fn):
+    "Load the EAST text detector once (per process and thread)"
+    if getattr(_nets, "net", None) is None: _nets.net = _load_neural_net(fn)
+    return _nets.net
 
 def intersection(a, b):
     startX = max( min(a[0], a[2]), min(b[0], b[2]) )
@@ -82,11 +86,10 @@ def _pad(x1,y1,x2,y2,pad = 1.2): # Pad as a factor
 
 def find_text_rects(img, nnfn, max_textareas = 50, min_areasize = 30):
     "nnfn = neural net file name"
-    # Uses a (module) global neural net _net
+    # Uses a (thread-local) neural net
     # Resize to a square
 #    orig = img.copy()
-    global _net
-    if _net is None: _net = _load_neural_net(nnfn)
+    net = load_neural_net(nnfn)
     (h0, w0) = img.shape[:2]
     (W, H) = (proc_size, proc_size)
     rW = w0 / float(W)
@@ -97,10 +100,10 @@ def find_text_rects(img, nnfn, max_textareas = 50, min_areasize = 30):
 	"feature_fusion/concat_3"]
     # Last argument : mean values for each RGB channel
     blob = cv2.dnn.blobFromImage(img, 1.0, (W, H),(123.68, 116.78, 103.94))
-    _net.setInput(blob)
+    net.setInput(blob)
     log.debug("Detecting text elements")
     try:
-        (scores, geometry) = _net.forward(layerNames)
+        (scores, geometry) = net.forward(layerNames)
         (numRows, numCols) = scores.shape[2:4]
     except cv2.error as msg: 
         log.warning(f"Neural net reported error {msg}")
@@ -160,13 +163,12 @@ def find_text_rects(img, nnfn, max_textareas = 50, min_areasize = 30):
     log.debug("... Found %i groups" % len(out))
     return out
 
-def ocr(rect, ocr_command, timeout=def_timeout,lang=def_lang,fdir=None):
-    "OCR text from a given rectangle (image array). Uses Tesseract"
+def ocr(rect, ocr_command, timeout=def_timeout,lang=def_lang,fdir=None, gamma=3):
+    "OCR text from a given rectangle (image array). Uses Tesseract. gamma: contrast increase, None if already applied"
     if pytesseract.pytesseract.tesseract_cmd is None:
         pytesseract.pytesseract.tesseract_cmd = ocr_command
 
-    increasecontast = True
-    if increasecontast: rect = jkm.tools.gammacorrect(rect,3)
+    if gamma: rect = jkm.tools.gammacorrect(rect,gamma)
     try:
         start_time = time.time()
         log.debug(f"Attempting OCR on an image area shape {rect.shape}")
@@ -0,0 +1,67 @@
+"""
+A simple stage-graph engine: a chain of processing stages connected by bounded queues.
+
+Each stage runs its function in its own worker threads, so that e.g. a slow OCR call does not
+stall image decoding or barcode reading of the samples behind it.
+"""
+import logging,  threading,  queue
+
+log = logging.getLogger() # Overwrite if needed
+_STOP = object() # End-of-life marker passed along the stages
+
+class Stage():
+    """One processing stage.
+
+func(item) returns the item to be passed to the next stage, or None to drop the item from the pipeline."""
+    def __init__(self, name, func, workers=1, maxsize=4):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(maxsize=max(1, maxsize)) # Input queue of the stage
+        self.threads = []
+    def qsize(self): return self.queue.qsize()
+
+class Pipeline():
+    """Run items through a list of Stage instances.
+
+on_finished(item) is called once for each item leaving the pipeline, whether it was completed, dropped or failed."""
+    def __init__(self, stages, on_finished=None):
+        self.stages = list(stages)
+        self.on_finished = on_finished
+        self._lock = threading.Lock()
+        self._in_flight = 0
+    @property
+    def in_flight(self):  return self._in_flight
+    def queue_sizes(self):
+        return {s.name: s.qsize() for s in self.stages}
+    def start(self):
+        for i, stage in enumerate(self.stages):
+            nextstage = self.stages[i+1] if i+1 < len(self.stages) else None
+            for n in range(stage.workers):
+                t = threading.Thread(target=self._run_stage, args=(stage, nextstage), name=f"{stage.name}-{n}", daemon=True)
+                t.start()
+                stage.threads.append(t)
+    def put(self, item):
+        "Submit an item to the first stage. Blocks while the first stage queue is full."
+        with self._lock: self._in_flight += 1
+        self.stages[0].queue.put(item)
+    def close(self):
+        "Let all submitted items run through the pipeline, then stop the stage threads"
+        for stage in self.stages:
+            for t in stage.threads: stage.queue.put(_STOP)
+            for t in stage.threads: t.join()
+    def _finished(self, item):
+        with self._lock: self._in_flight -= 1
+        if self.on_finished: self.on_finished(item)
+    def _run_stage(self, stage, nextstage):
+        while True:
+            item = stage.queue.get()
+            if item is _STOP: break
+            try:
+                out = stage.func(item)
+            except Exception as msg:
+                log.error(f"Pipeline stage {stage.name} failed: {msg}")
+                out = None
+            if out is None: self._finished(item)  # Dropped or failed
+            elif nextstage is None: self._finished(out)  # Completed
+            else: nextstage.queue.put(out)
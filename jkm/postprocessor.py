@@ -0,0 +1,360 @@
+"""
+Postprocessing of a single sample event (barcodes, text areas, OCR, renaming, metadata files).
+
+Used by jkm_postprocessing_cli.py in-process (one worker thread), in a process pool or as the stages of a jkm.pipeline.Pipeline.
+"""
+import logging,  logging.handlers,  time
+from datetime import datetime
+from pathlib import Path
+import cv2
+import jkm.configfile,  jkm.sample,  jkm.tools,  jkm.errors,  jkm.barcodes,  jkm.ocr,  jkm.ocr_analysis,  jkm.metadata,  jkm.ledger,  jkm.metrics,  jkm.imagecache,  jkm.pyramid,  jkm.derivatives,  jkm.quality
+
+log = logging.getLogger() # Overwrite if needed
+_conf = None # Configuration of a pool worker process, set by init_worker()
+
+def _UNIQUE(s) :return tuple(set(s))
+
+def set_module_loggers(logger):
+    "Make all jkm modules log to the given logger"
+    global log
+    log = logger
+    for m in (jkm.configfile,  jkm.tools,  jkm.ocr,  jkm.sample,  jkm.metadata,  jkm.barcodes,  jkm.ocr_analysis,  jkm.imagecache,  jkm.pyramid,  jkm.tiledreader,  jkm.derivatives,  jkm.quality):
+        m.log = logger
+
+class SampleResult():
+    "Picklable summary of one processed sample, returned from worker to main process"
+    def __init__(self, filename):
+        self.filename = filename
+        self.name = None
+        self.identifier = None
+        self.ocrdata = None # OCRAnalysisResult to be stored in the CSV table, if any
+        self.final_filename = None # Data file path after renaming
+        self.timings = {} # Seconds spent per stage, see jkm.metrics
+        self.counts = {} # Event counts, see jkm.metrics.count
+        self.processed = False
+    def as_dict(self):
+        "JSON serialisable summary, stored in the processing ledger"
+        return {"name": self.name, "identifier": self.identifier, "filename": str(self.filename),
+                "ocr": str(self.ocrdata) if self.ocrdata else ""}
+
+def configure_modules(conf):
+    "Apply the settings kept in module variables, in the main process and in each worker process"
+    jkm.imagecache.configure(conf.getf("postprocessor", "image_cache_mb", fallback=512))
+    jkm.tools.read_with_mmap = conf.getb("postprocessor", "read_with_mmap", fallback=False)
+    jkm.barcodes.configure(conf.get("barcodes", "qreader_model_size", fallback="l"), conf.getf("barcodes", "qreader_min_confidence", fallback=0.05))
+    jkm.barcodes.scale_stats = jkm.barcodes.ScaleStats(conf.geti("barcodes", "adaptive_min_samples", fallback=20),
+        conf.getf("barcodes", "adaptive_min_share", fallback=0.05)) if conf.getb("barcodes", "adaptive_scales", fallback=False) else None
+    jkm.barcodes.configure_cache(conf.get("barcodes", "barcode_cache_file", fallback=None))
+    jkm.barcodes.locate_maxdim = conf.getb("barcodes", "locate_then_decode", fallback=False) and conf.geti("barcodes", "locate_maxdim", fallback=2000)
+    jkm.derivatives.configure(conf.geti("postprocessor", "writer_threads", fallback=2), conf.geti("postprocessor", "writer_queue_size", fallback=16),
+                              conf.geti("postprocessor", "jpeg_quality", fallback=95), conf.geti("postprocessor", "png_compression", fallback=3))
+
+# ----------------- process pool support ------------------------
+def init_worker(conf_fn, logqueue, logname, debug=False):
+    """Process pool initializer.
+
+Reloads the configuration, sends log records to the main process and loads the EAST net and barcode backend once per process."""
+    global _conf
+    logger = logging.getLogger(logname)
+    logger.handlers.clear()
+    logger.addHandler(logging.handlers.QueueHandler(logqueue))
+    logger.setLevel(logging.DEBUG if debug else logging.INFO)
+    logger.propagate = False
+    set_module_loggers(logger)
+    _conf = jkm.configfile.Multicamconfig(conf_fn)
+    configure_modules(_conf)
+    if _conf.getb( "postprocessor", "read_barcodes"):
+        jkm.barcodes.load_backend( _conf.get( "barcodes", "barcodepackage").lower() )
+    if _conf.getb( "postprocessor", "find_text_areas"):
+        jkm.ocr.load_neural_net( _conf.get( "ocr", "EASTfile") )
+
+def close_worker():
+    "Process pool finalizer: write the derived images still queued before the worker process exits"
+    jkm.derivatives.close()
+
+def run_sample(filename):
+    "Process pool entry point, uses the configuration loaded by init_worker()"
+    return process_sample(_conf, filename)
+
+# ----------------- the postprocessor ------------------------
+def load_sample(conf, filename):
+    "Create a SampleEvent instance based on (meta)data file(s). Raises jkm.errors.FileLoadingError on failure."
+    sample_format = conf.get("sampleformat", "datatype_to_load").lower()
+    dirpath= filename.parent
+    if not dirpath.is_dir():
+        raise jkm.errors.FileLoadingError(f"Cannot find path {dirpath},  skipping to next sample")
+    if sample_format == "mzh_insectline":
+        return jkm.sample.LuomusInsectLineSample.from_directory(dirpath, conf)
+    elif sample_format ==  "mzh_plantline":
+        return jkm.sample.LuomusPlantLineSample.from_directory(dirpath, conf)
+    elif sample_format == "singlefile":
+        return jkm.sample.SingleImageSample.from_image_file(filename, conf, "generic_camera")
+    else:
+        raise jkm.errors.FileLoadingError(f"Unknown sample file/directory format {sample_format}")
+
+# Settings that affect only how samples are scheduled or how fast they are processed, not the results.
+# Register every new setting of this kind here, otherwise changing it makes all samples be processed again.
+_execution_settings = ("monitor", "process_existing", "workers", "staged_pipeline", "stage_workers", "stage_queue_size",
+                       "sleep_after_new_sample_detected", "file_settle_time", "ledger_file", "queue_size", "backlog_max_delay",
+                       "event_window", "metrics_file", "stats_file", "metrics_interval", "status_port", "isolate_workers",
+                       "worker_timeout", "quarantine_file", "image_cache_mb", "read_with_mmap",
+                       "prefetch", "prefetch_samples", "prefetch_mb", "prefetch_decode", "writer_threads", "writer_queue_size",
+                       "barcode_cache_file", "reduced_decoding",
+                       "adaptive_scales", "adaptive_min_samples", "adaptive_min_share")
+
+def config_hash(conf):
+    "Hash of the settings affecting postprocessing results, used as part of the processing ledger key"
+    return jkm.ledger.config_hash(conf, ("basic", "sampleformat", "postprocessor", "ocr", "barcodes"), _execution_settings)
+
+def expected_sample_files(conf):
+    "Names of the files (relative to the sample directory) that must be present before a sample can be processed"
+    sample_format = conf.get("sampleformat", "datatype_to_load").lower()
+    if sample_format == "mzh_insectline":
+        return [conf.get("sampleformat", "label_file")] + conf.getlist("sampleformat", "object_files")
+    elif sample_format ==  "mzh_plantline":
+        return [conf.get("sampleformat", "label_file")]
+    return [] # singlefile: only the data file itself
+
+def sample_image_files(conf, filename):
+    "Paths of the image files of the sample identified by data file filename"
+    return [filename] + [filename.parent / x for x in expected_sample_files(conf) if x != filename.name]
+
+def read_sample_files(conf, filename, decode=False):
+    "Read the image files of a sample into memory, returns a dict path: file contents (bytes), or decoded images if decode"
+    data = {}
+    for path in sample_image_files(conf, Path(filename)):
+        try: data[str(path)] = jkm.tools.load_img(path) if decode else path.read_bytes()
+        except (OSError, jkm.errors.FileLoadingError) as msg: log.debug(f"Cannot read {path} ahead: {msg}")
+    return data
+
+class SampleJob():
+    "State of one sample travelling through the postprocessing stages"
+    def __init__(self, filename, prefetched=None):
+        self.filename = Path(filename)
+        self.prefetched = prefetched or {} # Image file path: contents or decoded image, read ahead by jkm.prefetch
+        self.created = time.perf_counter()
+        self.sample = None
+        self.allbkdata = []
+        self.alltext = ""
+        self.quality = {} # Image label: quality metrics, see jkm.quality
+        self.result = SampleResult(self.filename)
+
+# ----------------- postprocessing stages ------------------------
+# Each stage function takes (conf, job) and returns the job, or None if processing of the sample ends.
+def stage_decode(conf, job):
+    "Load the sample, decode and rotate its images"
+    filename = job.filename
+    if not filename.exists():  #" File may aleady have been deleted, renamed etc.
+        log.warning(f"Could not find file {filename}, skipping")
+        return None
+    log.debug(f"Processing data file {filename}" )
+    try:
+        sample = load_sample(conf, filename)
+    except jkm.errors.FileLoadingError:
+        return None
+    job.sample = sample
+    job.result.name = sample.name
+    # MAIN POSTPROCESSOR STARTS HERE
+    log.info(f"Postprocessing sample {sample.name}")
+    timings = job.result.timings
+    # ROTATE (images are rotated as they are decoded)
+    rot = conf.geti( "postprocessor", "rotate_before_processing")
+    if rot: # non-zero value
+        for image in sample.imagelist:
+            log.debug(f"{sample.name}: Rotating image {image.name}")
+            image.rotate(rot)
+    for image in sample.imagelist:
+        data = job.prefetched.pop(str(image.path), None)
+        if data is not None: image.attachData(data)
+    with jkm.metrics.timed(timings, "load"):
+        for image in sample.imagelist:
+            try: 
+                if not conf.getb( "postprocessor", "reduced_decoding", fallback=False): image.readImage(rotated=False)
+                else: # Only the reduced-resolution images needed by barcode reading and text area detection
+                    # (the base of the image pyramid, see jkm.pyramid)
+                    if conf.getb( "postprocessor", "read_barcodes"): image.readReduced(image.pyramid.base_dim, grayscale=True)
+                    if conf.getb( "postprocessor", "find_text_areas") and image.has_labels: image.readReduced(image.pyramid.base_dim)
+            except jkm.errors.FileLoadingError: pass # Reported by the stages using the image
+    # QUALITY METRICS
+    if conf.getb( "postprocessor", "quality_metrics", fallback=False):
+        maxdim = conf.geti( "postprocessor", "quality_level", fallback=1000)
+        limits = [conf.getf( "postprocessor", k, fallback=0) for k in ("min_sharpness", "max_clipping", "max_colour_cast")]
+        with jkm.metrics.timed(timings, "quality"):
+            for image in sample.imagelist:
+                try: q = jkm.quality.measure(image.pyramid, maxdim)
+                except jkm.errors.FileLoadingError: continue # Reported by the stages using the image
+                except cv2.error as msg:
+                    log.warning(f"{sample.name}: Measuring the quality of {image.label} failed: {msg}")
+                    continue
+                job.quality[image.label] = q
+                image.meta.addlog("Image quality", q, lvl=logging.DEBUG, log_add_hdr= sample.name)
+                problems = jkm.quality.problems(q, *limits)
+                if problems: image.meta.addlog("Image quality problems", ", ".join(problems), lvl=logging.WARNING, log_add_hdr= sample.name)
+    # SAVE ROTATED
+    if rot and conf.getb( "postprocessor", "save_rotated", fallback=False):
+        with jkm.metrics.timed(timings, "saverotated"):
+            for image in sample.imagelist:
+                fn = Path(image.filename)
+                try: jkm.derivatives.save(fn.with_name(f"{fn.stem}_rotated{fn.suffix}"), image.readImage()) # Written in the background
+                except jkm.errors.FileLoadingError: pass # Reported by the stages using the image
+    return job
+
+def stage_barcodes(conf, job):
+    "Find barcodes"
+    sample = job.sample
+    if conf.getb( "postprocessor", "read_barcodes"):
+        barcodepackage = conf.get( "barcodes", "barcodepackage").lower()
+        for image in sample.imagelist:
+            try:
+                # NOTE: the choice of barcose detector tool is hardcoded in jkm/barcodes.py
+                info = {}
+                with jkm.metrics.timed(job.result.timings, "readbarcodes"): bkdata = image.readbarcodes(barcodepackage, info)
+                for scale in info.get("scales", []): jkm.metrics.count(job.result.counts, "barcode_scale_attempts", station=image.label, scale=scale or "full")
+                if "scale" in info: jkm.metrics.count(job.result.counts, "barcode_scale_hits", station=image.label, scale=info["scale"] or "full")
+                if jkm.barcodes.barcode_cache: jkm.metrics.count(job.result.counts, "barcode_cache", result="hit" if info.get("cached") else "miss")
+                image.meta.addlog("Barcode contents", bkdata, log_add_hdr= sample.name)
+                job.allbkdata += bkdata
+            except jkm.errors.FileLoadingError as msg:
+                log.warning(f"{sample.name}: Barcode detection attempt failed: %s" % msg)
+                continue
+    return job
+
+def stage_textareas(conf, job):
+    "Find text areas"
+    sample = job.sample
+    if conf.getb( "postprocessor", "find_text_areas"):
+        for image in sample.imagelist:
+            if not image.has_labels : continue # Skip pure specimen images
+            log.debug(f"Searching for text areas in {image.label} of sample {sample.name}")
+            neuralnet = conf.get( "ocr", "EASTfile")
+            with jkm.metrics.timed(job.result.timings, "findtextareas"): textareas = image.findtextareas(neuralnet)
+            image.meta.addlog("Text areas found", str(textareas),  log_add_hdr= sample.name)
+            if conf.getb( "postprocessor", "save_text_area_images"):
+                with jkm.metrics.timed(job.result.timings, "savetextareas"): image.savetextareas("_textarea_")
+    return job
+
+def stage_ocr(conf, job):
+    "Perform OCR"
+    sample = job.sample
+    if conf.getb( "postprocessor", "ocr"):
+        ocr_command = conf.get("ocr", "ocr_command")
+        for image in sample.imagelist:
+            if not image.has_labels : continue # Skip pure specimen images
+            with jkm.metrics.timed(job.result.timings, "ocr"):
+                labeltxt = image.ocr(ocr_command) # Default ocr uses fragments created above
+            job.alltext  += " " + labeltxt
+#                image.meta.addlog("OCR result for image", labeltxt,lvl=logging.DEBUG)
+        sample.meta.addlog("Combined OCR result for all images",job.alltext,  log_add_hdr= sample.name)
+    return job
+
+def stage_persist(conf, job):
+    "Choose the identifier, rename directories and files and write metadata files"
+    sample = job.sample
+    result = job.result
+    alltext = job.alltext
+    allbkdata = job.allbkdata
+    # EXTRACT IDENTIFIERS FROM OCR DATA (NOT IMPLEMENTED)
+
+    # SUBMIT alltext to COMPONENT ANALYSIS
+    # if conf.getb( "postprocessor", "ocr") and conf.getb( "postprocessor", "ocr_analysis"):
+        # ocrdata = jkm.ocr_analysis.ocr_analysis_Luomus(alltext)
+        # log.debug(f"{sample.name}: OCR data parsing output: {ocrdata}")
+    # else: log.debug(f"{sample.name}: No OCR data parsing attempted.")
+    # SIMPLE IMPLEMENTATION FOR TESTING
+    cleantext = jkm.ocr_analysis.cleanup(alltext)
+    ocrdata = jkm.ocr_analysis.OCRAnalysisResult()
+    ocrdata.append("ocr",cleantext)
+
+     # FOR FURTHER PROCESSING, CHECK IF IDENTIFIER LIST CONTAINS A SINGLE VALID IDENTIFIER
+    # In case sample does already have a known identifier, append to to the list
+    if sample.identifier: allbkdata.append(sample.identifier)
+    sampleids = _UNIQUE(allbkdata)
+    if len(sampleids) == 0:
+        log.warning("No usable identifiers found")
+    elif len(sampleids) > 1:
+        log.warning("Several  different identifiers for the sample in barcodes/OCR/sample metadata")
+    else: sample.identifier =  sampleids[0] # Sets also sample.shortidentifier
+    result.identifier = sample.identifier
+
+    # Interpreted data is stored in a table file by the main process IF data and identifier are available
+    if sample.identifier:
+        ocrdata.prepend("identifier", sample.identifier)
+        result.ocrdata = ocrdata
+
+    datafile_image = next((x for x in sample.imagelist if Path(x.filename) == job.filename), None)
+    with jkm.metrics.timed(result.timings, "rename"):
+        # Text area crops and rotated images are queued with paths in the old directory: write them before renaming
+        if conf.getb( "basic", "directories_rename_by_barcode_id") or conf.getb( "basic", "files_rename_by_barcode_id"):
+            jkm.derivatives.flush()
+        # RENAME DIRECTORIES (this may need to stay above file renaming)
+        if conf.getb( "basic", "directories_rename_by_barcode_id") and sample.identifier:
+            prefix = sample.datapath.name # last element of directory path
+            log.debug("Renaming directory based on barcode content")
+            try:
+                sample.rename_directories(conf,prefix)
+            except (jkm.errors.JKError, FileNotFoundError) as msg:
+                log.warning(f"Renaming directory failed: {msg}. Maybe it has already been renamed.")
+
+        # RENAME FILES
+        # Current implementation renames only the original image files as per the configuration file
+        if conf.getb( "basic", "files_rename_by_barcode_id") and sample.shortidentifier:
+            try:
+                sample.rename_all_files(sample.shortidentifier)
+            except (jkm.errors.JKError, FileNotFoundError) as msg:
+                log.warning(f"Renaming files failed: {msg}.")
+
+    datafile_name = datafile_image.path.name if datafile_image else job.filename.name
+    result.final_filename = Path(sample.datapath) / datafile_name
+
+    with jkm.metrics.timed(result.timings, "write"):
+        # Write records to JSON Metadata file (should this be before renaming?)
+        if conf.getb( "basic", "save_JSON"): sample.writeMetaJSON()
+
+        # FOR MZH IMAGING LINE SAMPLES
+        if conf.get("sampleformat", "datatype_to_load").lower()  in ["mzh_insectline", "mzh_plantline"]:
+            # Write postprocessor.properties file
+            sample.digipropfile.setheader( f"# {datetime.now()}" )
+            sample.digipropfile.update("full_barcode_data",sample.identifier or "")
+            sample.digipropfile.update("identifier",sample.shortidentifier  or "")
+            sample.digipropfile.update("timestamp",sample.original_timestamp())
+            if sample.identifier: # Only one identifier-containing barcode was found
+                id_OK = sample.verify_identifier()
+                if not id_OK:
+                    log.critical(f"{sample.name}: *******\n\n\n\nMALFORMED IDENTIFIER {sample.identifier}*******\n\n\n\n")
+                sample.digipropfile.update("URI_format_OK", str(id_OK) )
+            # The worst values of the sample images
+            sample.digipropfile.update("Q-sharp", str(min(q["sharpness"] for q in job.quality.values())) if job.quality else "" )
+            sample.digipropfile.update("Q-color", str(max(q["colour_cast"] for q in job.quality.values())) if job.quality else "" )
+            if conf.getb( "postprocessor", "ocr"):
+                sample.digipropfile.update("OCR_result", alltext.replace("\n"," "))
+            sample.digipropfile.save( sample.datapath /  Path(r"postprocessor.properties") )
+    result.processed = True
+    return job
+
+def derivative_sizes(conf):
+    "Names and sizes of the downscaled copies written by stage_derivatives, {name: maximum length of the longer side}"
+    return conf.getlist( "postprocessor", "derivative_sizes", fallback='{"thumb": 200, "preview": 1200}')
+
+def stage_derivatives(conf, job):
+    "Write thumbnails and previews of the images under their final names, then free the image data"
+    sample = job.sample
+    if conf.getb( "postprocessor", "save_derivatives", fallback=False):
+        sizes = derivative_sizes(conf)
+        with jkm.metrics.timed(job.result.timings, "derivatives"):
+            for image in sample.imagelist:
+                try: image.savederivatives(sizes)
+                except (jkm.errors.FileLoadingError, OSError) as msg: log.warning(f"{sample.name}: Saving derivatives of {image.label} failed: {msg}")
+    #DONE
+    for image in sample.imagelist: image.unloadImageData() # Free the image cache for the next samples
+    return job
+
+STAGES = (("decode", stage_decode), ("barcode", stage_barcodes), ("textareas", stage_textareas), 
+          ("ocr", stage_ocr), ("persist", stage_persist), ("derivatives", stage_derivatives))
+
+def process_sample(conf, filename, prefetched=None):
+    "Run all postprocessing stages on the sample identified by data file filename. Returns a SampleResult."
+    job = SampleJob(filename, prefetched)
+    with jkm.metrics.timed(job.result.timings, "total"):
+        for name, stagefunc in STAGES:
+            if stagefunc(conf, job) is None: break
+    return job.result
@@ -0,0 +1,60 @@
+"""
+Read-ahead of sample image files.
+
+The next samples waiting in the queue are read into memory (and optionally decoded) by background threads,
+so that the processing workers do not wait for slow disks or network shares.
+"""
+import logging,  threading,  queue
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger() # Overwrite if needed
+
+def data_size(data):
+    "Size in bytes of prefetched data: a dict of path: encoded bytes or decoded image array"
+    return sum(getattr(x, "nbytes", None) or len(x) for x in data.values()) if data else 0
+
+class Prefetcher():
+    """Take items from a queue and read their files ahead of the consumers.
+
+read(item) returns the data of an item (a dict path: bytes or image array). Items are passed on in queue order.
+At most depth items, and about max_bytes of data, are waiting for consumers at a time.
+None (the end-of-life marker for workers) is passed on as it is."""
+    def __init__(self, get_item, read, depth=4, max_bytes=256*2**20, readers=2):
+        self.get_item = get_item
+        self.read = read
+        self.max_bytes = max_bytes
+        self.nbytes = 0 # Data read and waiting for consumers
+        self._out = queue.Queue(maxsize=max(1, depth)) # Futures of the items in queue order
+        self._pool = ThreadPoolExecutor(max_workers=max(1, readers), thread_name_prefix="prefetch")
+        self._cond = threading.Condition()
+        self._thread = None
+    @property
+    def waiting(self): return self._out.qsize() # Items read or being read, not yet taken by consumers
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="prefetcher", daemon=True)
+        self._thread.start()
+    def get(self):
+        "Returns (item, data) of the next item, blocks until it has been read. data is None for None and failed reads."
+        item, future = self._out.get()
+        if item is None: return None, None
+        try: data = future.result()
+        except Exception as msg:
+            log.warning(f"Reading files of {item} ahead failed, they are read again when processed: {msg}")
+            return item, None
+        with self._cond:
+            self.nbytes -= data_size(data)
+            self._cond.notify_all()
+        return item, data
+    def _read(self, item):
+        data = self.read(item)
+        with self._cond: self.nbytes += data_size(data)
+        return data
+    def _run(self):
+        while True:
+            item = self.get_item()
+            if item is None:
+                self._out.put((None, None))
+                continue # The queue may have one end-of-life marker per consumer
+            with self._cond: # Reads in progress are not counted, so the budget can be exceeded by up to one item per reader
+                while self.nbytes >= self.max_bytes: self._cond.wait()
+            self._out.put((item, self._pool.submit(self._read, item))) # Blocks while depth items are waiting
@@ -0,0 +1,39 @@
+"""
+Image pyramid: downscaled versions of a sample image shared by barcode reading, text area detection and cropping.
+
+Levels are identified by the maximum length of the longer side. They are built lazily, once, and kept in the
+image cache (jkm.imagecache) with the other views of the image.
+"""
+import logging
+import jkm.tools
+
+log = logging.getLogger() # Overwrite if needed
+
+class ImagePyramid():
+    """Levels of one jkm.sample.SampleImage.
+
+Levels up to base_dim are made from one reduced-resolution decode (see SampleImage.readReduced), larger ones
+and level None (full resolution) from the full image."""
+    def __init__(self, image, base_dim=2000):
+        self.image = image
+        self.base_dim = base_dim
+    def level(self, maxdim=None, grayscale=False, rotated=False):
+        """Returns (image, scale): the image with its longer side at most maxdim px (never enlarged), and the factor
+converting level coordinates to full image coordinates. maxdim None = full resolution.
+
+Levels are unrotated (e.g. for barcode reading) unless rotated, then the image rotation is applied to the level only."""
+        img, scale = self._level(maxdim, grayscale)
+        angle = self.image.rotation if rotated else 0
+        if angle: img = self.image.view(("level", maxdim, "grey" if grayscale else "colour", angle), lambda: jkm.tools.rotate_img(img, angle))
+        return img, scale
+    def _level(self, maxdim, grayscale):
+        if maxdim is None or maxdim > self.base_dim: src, reduction = self.full(grayscale), 1
+        else: src, reduction = self.image.readReduced(self.base_dim, grayscale)
+        if maxdim is None or maxdim >= max(src.shape[:2]): return src, reduction
+        img = self.image.view(("level", maxdim, "grey" if grayscale else "colour"), lambda: jkm.tools.shrink_to_maxdim(src, maxdim))
+        return img, reduction*max(src.shape[:2])/max(img.shape[:2])
+    def full(self, grayscale=False):
+        "The unrotated full resolution image"
+        img = self.image.readImage(rotated=False)
+        if not grayscale: return img
+        return self.image.view(("level", None, "grey"), lambda: jkm.tools.to_grey(img))
@@ -0,0 +1,52 @@
+"""
+Image quality metrics for flagging failed captures: sharpness (Q-sharp), exposure clipping and colour cast (Q-color).
+
+Computed on a downscaled level of the image pyramid (jkm.pyramid), a few milliseconds per image. Sharpness depends
+on the level size, so compare only values computed with the same quality_level setting.
+"""
+import logging
+import cv2
+import numpy as np
+import jkm.tools
+
+log = logging.getLogger() # Overwrite if needed
+
+def sharpness(grey):
+    "Variance of the Laplacian: low for blurred or out of focus images"
+    return cv2.Laplacian(grey, cv2.CV_64F).var()
+
+def clipping(grey, low=2, high=253):
+    "Fractions of pixels at or below low (underexposed) and at or above high (overexposed)"
+    hist = np.bincount(grey.ravel(), minlength=256)
+    return hist[:low+1].sum()/grey.size, hist[high:].sum()/grey.size
+
+def to_8bit(img):
+    "8-bit version of a 16-bit or floating point (0-1) image, e.g. from a TIFF file"
+    if img.dtype == np.uint8: return img
+    scale = 255/np.iinfo(img.dtype).max if np.issubdtype(img.dtype, np.integer) else 255
+    return cv2.convertScaleAbs(img, alpha=scale)
+
+def colour_cast(img):
+    "Mean offsets of the CIELAB a (green-red) and b (blue-yellow) channels from neutral grey, and their length"
+    _, a, b, _ = cv2.mean(cv2.cvtColor(img[:, :, :3], cv2.COLOR_BGR2LAB))
+    a, b = a-128, b-128
+    return a, b, float(np.hypot(a, b))
+
+def measure(pyramid, maxdim=1000):
+    "Quality metrics of the image of a jkm.pyramid.ImagePyramid, as a dict"
+    img, scale = pyramid.level(maxdim)
+    img = to_8bit(img)
+    grey = jkm.tools.to_grey(img) # Not another pyramid level, which could mean decoding the image again
+    dark, bright = clipping(grey)
+    a, b, cast = colour_cast(img) if img.ndim == 3 else (0, 0, 0)
+    q = {"sharpness": sharpness(grey), "clipped_dark": dark, "clipped_bright": bright, "cast_a": a, "cast_b": b, "colour_cast": cast}
+    return {k: round(float(v), 4) for k, v in q.items()}
+
+def problems(q, min_sharpness=0, max_clipping=0, max_cast=0):
+    "Descriptions of the limits exceeded by the metrics q (see measure). Limits 0 are not checked."
+    found = []
+    if min_sharpness and q["sharpness"] < min_sharpness: found.append(f"possibly out of focus (sharpness {q['sharpness']})")
+    if max_clipping and q["clipped_dark"] > max_clipping: found.append(f"underexposed ({q['clipped_dark']:.1%} black)")
+    if max_clipping and q["clipped_bright"] > max_clipping: found.append(f"overexposed ({q['clipped_bright']:.1%} white)")
+    if max_cast and q["colour_cast"] > max_cast: found.append(f"colour cast {q['colour_cast']}")
+    return found
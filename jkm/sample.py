@@ -6,14 +6,17 @@ import cv2
 import jsonpickle
 import jkm.metadata
 import jkm.ocr
+import jkm.barcodes
 import jkm.tools
+import jkm.imagecache
+import jkm.pyramid
+import jkm.tiledreader
+import jkm.derivatives
 from jkm.digitisation_properties import DigipropFile
 import jkm.errors
 
 log = logging.getLogger() # Overwrite if needed
-deg2rotcode = {90: cv2.ROTATE_90_CLOCKWISE,
-               180: cv2.ROTATE_180,
-               270: cv2.ROTATE_90_COUNTERCLOCKWISE}
+deg2rotcode = jkm.tools.deg2rotcode
 
 # Helper functions
 def _UNIQUE(s) :return list(set(s))
@@ -135,12 +138,20 @@ class SampleImage(SampleBase):
         self.label= label
         self.meta = jkm.metadata.ImageMetadata(self.label)  #Image-level metadata
         self.confsection= None
-        self._img = None  # Full image data loaded to memory (set to None if not yet loaded)
+        self._cacheid = jkm.imagecache.new_owner() # Image data and derived views are kept in jkm.imagecache.cache
+        self._rotation = 0 # Clockwise rotation (see rotate), image data is kept unrotated in memory
+        self._encoded = None # File contents read ahead (see attachData), decoded instead of reading the file
+        self._size = None # (width, height) of the full image, see fullSize
         self._fn = fn
         # Record colorspace!
     @property
     def filename(self):  return self._fn
     @property
+    def rotation(self):  return self._rotation
+    @property
+    def pyramid(self):  # Levels are stored in the image cache, so the pyramid object itself has no state to keep
+        return jkm.pyramid.ImagePyramid(self)
+    @property
     def path(self):  # Note: fails is _self._fn is still set to None
         return Path(self._fn)
     def samefile(self,fn):
@@ -151,10 +162,15 @@ class SampleImage(SampleBase):
         self.path.rename(newpath)
         self._fn = newpath
     def unloadImageData(self): 
-        self._img = None  # Delete in-memory copy of image data 
+        jkm.imagecache.cache.discard(self._cacheid)  # Delete in-memory copies of image data 
+        self._encoded = None
+        self._size = None
+    def attachData(self, data):
+        "Use file contents (bytes) or a decoded image array already read into memory, e.g. by jkm.prefetch"
+        if getattr(data, "ndim", 1) == 1: self._encoded = data
+        else: jkm.imagecache.cache.put((self._cacheid, "full"), data)
     def encodeJSON(self):
         "Return a JSON serializable representation."
-        self._img = None # Do not serialise in-memory copy of image
         d = {}
         d[f"__{type(self).__name__}__"] = True
         d['label'] = self.label
@@ -162,22 +178,56 @@ class SampleImage(SampleBase):
         d['_fn'] = self._fn
         d['meta'] = self.meta.encodeJSON()
         return d
-    def readImage(self,filename = None, colourspace = cv2.IMREAD_COLOR,  force_reload=False): 
+    def readImage(self,filename = None, colourspace = cv2.IMREAD_COLOR,  force_reload=False, rotated=True): 
         """Returns image as a cv2/numpy array. 
         
         Loads data from disk if it has not already been loaded. Reloading can be forced using the force_reload flag. 
+        A rotated full resolution copy is made only if rotated and the image has been rotated (see rotate).
         Raises jkm.errors.FileLoadingError is datais not accessible"""
-        if (self._img is not None) and (not force_reload) and (filename == None): return self._img 
+        if force_reload or filename is not None: 
+            self.unloadImageData()
+            self._fn = Path(filename or self._fn) # Use filename from mothod call, if any
+        img = self.view(("full",), lambda: self._load())
+        if not (rotated and self._rotation): return img
+        return self.view(("rotated", self._rotation), lambda: jkm.tools.rotate_img(img, self._rotation))
+    def _load(self, reduction=1, grayscale=False):
         try:
-            fn = filename or self._fn  # Use filename from mothod call, if any
-            # HACK:
-            self._fn = Path(fn)
-            self._img = jkm.tools.load_img(fn)
+            img = jkm.tools.load_img(self._fn if self._encoded is None else self._encoded, reduction, grayscale)
 #            self._img = cv2.imread(str(fn), colourspace)            
-            return self._img
         except SystemError as msg:
-            log.warning(f"Reading file {str(filename)} failed" )
+            log.warning(f"Reading file {str(self._fn)} failed" )
             raise jkm.errors.FileLoadingError(msg)
+        return img
+    def view(self, name, make):
+        "Returns a cached view of this image identified by the tuple name, calling make() to create it if needed"
+        return jkm.imagecache.cache.get_or_create((self._cacheid,) + name, make)
+    def readReduced(self, min_dim, grayscale=False):
+        """Returns (image, reduction): the unrotated image at 1/reduction resolution, longer side still at least min_dim pixels.
+
+JPEG files are decoded directly at reduced resolution and large TIFF files read in windows (see jkm.tiledreader), 
+without a full decode. If the full image is already in memory, the reduced image is made from it. 
+Multiply coordinates by reduction to get full image coordinates."""
+        full = jkm.imagecache.cache.get((self._cacheid, "full"))
+        size = (full.shape[1], full.shape[0]) if full is not None else self.fullSize()
+        reduction = next((r for r in (8, 4, 2) if size and max(size)/r >= min_dim), 1)
+        def make():
+            reader = self.windowReader() if full is None else None
+            if reader: return reader.read(None, 1/reduction, grayscale)
+            if full is None: return self._load(reduction, grayscale)
+            img = full if reduction == 1 else cv2.resize(full, (0,0), fx=1/reduction, fy=1/reduction, interpolation=cv2.INTER_AREA)
+            return jkm.tools.to_grey(img) if grayscale else img
+        return self.view((reduction, "grey" if grayscale else "colour"), make), reduction
+    def fullSize(self):
+        """(width, height) of the full image, from the decoded image, prefetched data or the file header (JPEG and windowed TIFF files).
+
+Read once per image, None if unknown without decoding."""
+        if self._size is None:
+            full = jkm.imagecache.cache.get((self._cacheid, "full"))
+            if full is not None: self._size = (full.shape[1], full.shape[0])
+            else:
+                reader = self.windowReader()
+                self._size = (reader.size if reader else jkm.tools.jpeg_size(self._fn if self._encoded is None else self._encoded)) or ()
+        return self._size or None
 #    def writeImage(filename): pass
     def copyMetadatafFomConf(self, configobject):
         cf = configobject
@@ -187,23 +237,51 @@ class SampleImage(SampleBase):
         self.meta.add(title,  content)
     def addlogMeta(self,title,content="",lvl=logging.INFO):
         self.meta.addlog(title,  content, lvl=lvl)
-    def getsubimage(self,  rect):
-        "Rect to [x1,y1,x2,y2,rot] from upper left corner"
+    def windowReader(self):
+        "A jkm.tiledreader.WindowReader if the image is a file that can be read in windows and is not yet in memory, otherwise None"
+        if self._encoded is not None or jkm.imagecache.cache.get((self._cacheid, "full")) is not None: return None
+        return jkm.tiledreader.window_reader(self._fn)
+    def cropSource(self):
+        "The unrotated full image, or a WindowReader for large files, for cutting several areas with getsubimage"
+        return self.windowReader() or self.readImage(rotated=False)
+    def getsubimage(self,  rect, img=None):
+        """Rect to [x1,y1,x2,y2,rot] from upper left corner, in rotated image coordinates. 
+
+img: the result of cropSource(), if already at hand. The area is cut from the unrotated image, then only the crop is rotated."""
+        if img is None: img = self.cropSource()
+        windowed = isinstance(img, jkm.tiledreader.WindowReader)
+        w, h = img.size if windowed else (img.shape[1], img.shape[0])
+        if self._rotation: rect = jkm.tools.unrotate_rect(rect, self._rotation, w, h)
         x1,y1,x2,y2,rot = rect
-        img = self.readImage()
-        return img[y1:y2, x1:x2] 
-    def readbarcodes(self, qrpackage):
-        img = self.readImage()
-        bkdata = jkm.barcodes.extractbarcodedata(img, qrpackage, encoding='ascii')
+        return jkm.tools.rotate_img(img.read(rect) if windowed else img[y1:y2, x1:x2], self._rotation)
+    def savederivatives(self, sizes):
+        """Write downscaled copies of the (rotated) image, sizes: dict name: maximum length of the longer side. Returns the file names written.
+
+Copies are named <image name>_<name>.jpg and made from the image pyramid, only if missing or older than the image file."""
+        src = self.path
+        written = []
+        for name, maxdim in sizes.items():
+            fn = src.with_name(f"{src.stem}_{name}.jpg")
+            if fn.exists() and fn.stat().st_mtime >= src.stat().st_mtime: continue # Up to date
+            img, scale = self.pyramid.level(int(maxdim), rotated=True)
+            log.debug(f"Storing {name} image: {fn}")
+            jkm.derivatives.save(fn, img) # Encoded and written in the background
+            written.append(fn)
+        return written
+    def readbarcodes(self, qrpackage, info=None):
+        "Barcodes are searched in the downscaled (unrotated) levels of the image pyramid first, the full image is decoded only if needed"
+        info = {} if info is None else info # Decoding details, see jkm.barcodes.extractbarcodedata
+        bkdata = jkm.barcodes.extractbarcodedata(None, qrpackage, encoding='ascii', pyramid=self.pyramid, info=info, station=self.label,
+                                                 source=self.path if self._encoded is None else self._encoded)
+        if info["backend"]: self.meta.add("Barcode reader", info["backend"])
         return bkdata        
     def rotate(self, angle): # angle = 0,90,180,270
         print("ROTATE CALLED")
         angle = int(angle)
         if angle:
             print("ROTATING", self.name)
-            img = self.readImage()
-            rotcode = deg2rotcode[angle]
-            self._img = cv2.rotate(img, rotateCode = rotcode)
+            # Only a transform: pyramid levels, crops and readImage() results are rotated when they are made
+            self._rotation = (self._rotation + angle) % 360
         
 #------------------------------------------------------------------------------------------------------    
 class SpecimenImage(SampleImage):
@@ -224,20 +302,21 @@ class LabelImage(SampleImage):
         "Access textareas once they have been identified using findtextareas()"
         return self._textareas
     def findtextareas(self,  nnfn):
-        "Find areas with text using EAST text detector"
-        img = self.readImage()
+        "Find areas with text using EAST text detector, on a pyramid level somewhat larger than the detector input"
         log.debug("Find areas with text using EAST text detector")
-        self._textareas = jkm.ocr.find_text_rects(img,nnfn)
+        img, scale = self.pyramid.level(2*jkm.ocr.proc_size, rotated=True)
+        self._textareas = [tuple(int(c*scale) for c in rect[:4]) + (rect[4],) for rect in jkm.ocr.find_text_rects(img,nnfn)]
         return self._textareas
     def savetextareas(self, namehdr):
         x = 1
         try:
+            img = self.cropSource() if self._textareas else None # Crops are cut from the unrotated full resolution image
             for rect in self._textareas:
-                imgx = self.getsubimage(rect) # Get subimage            
+                imgx = self.getsubimage(rect, img) # Get subimage            
                 imgname = self.filename.stem
                 fullfn = self.filename.with_name(f"{imgname}{namehdr}{x}.jpg")
                 log.debug(f"Storing individual label image: {fullfn}")
-                jkm.tools.save_img(fullfn,imgx)
+                jkm.derivatives.save(fullfn,imgx) # Encoded and written in the background
                 x += 1
         except IOError: pass
     def ocr(self, ocrcommand, force_all_image_ocr = False): 
@@ -245,13 +324,15 @@ class LabelImage(SampleImage):
         txt = ""
         if not self._textareas or force_all_image_ocr:
             log.debug(f"OCR call for {self.label}, full frame")
-            img = self.readImage()
-            txt = jkm.ocr.ocr(img,ocrcommand)
+            img = self.view(("rotated", self._rotation, "gamma3"), lambda: jkm.tools.gammacorrect(self.readImage(),3))
+            txt = jkm.ocr.ocr(img,ocrcommand,gamma=None)
         else:  # OCR recognised text areas one at a time
             x = 1
+            img = self.cropSource()
             for area in self._textareas:
                 log.debug(f"OCR call for {self.label}, text area {x}")
-                txt += " " + jkm.ocr.ocr(self.getsubimage(area),ocrcommand)
+                crop = self.view(("crop", area, "gamma3"), lambda: jkm.tools.gammacorrect(self.getsubimage(area, img),3))
+                txt += " " + jkm.ocr.ocr(crop,ocrcommand,gamma=None)
                 x += 1
         return txt
 #    def readMetadata(self): pass
@@ -317,6 +398,8 @@ class LuomusLineSample(SampleEvent):
                     newpath = basepath / newprefix 
                 log.debug(f"Renaming {self.datapath} to {newpath}")        
                 self.datapath.rename(newpath) 
+                for image in self.imagelist: # The image files moved with the directory
+                    if image.path.parent == Path(self.datapath): image._fn = newpath / image.path.name
         except PermissionError as msg:
             log.warning("Renaming directory failed with error message: %s" % msg)
         except FileExistsError as msg:
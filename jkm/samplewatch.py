@@ -0,0 +1,178 @@
+"""
+Detection of new samples that have been completely written to disk.
+
+File system events are first merged per sample (EventCoalescer), then a sample is handed on for
+processing as soon as all of its files are present and complete (ReadinessDetector).
+"""
+import logging,  threading,  time,  os,  fnmatch
+from collections import OrderedDict
+from pathlib import Path
+
+log = logging.getLogger() # Overwrite if needed
+derived_markers = ["textarea", "_rotated"] # Parts of the names of images written by the postprocessor (see jkm.derivatives)
+
+def is_derived(path):
+    "True if the file is an image written by the postprocessor, e.g. a text area crop or a rotated copy (case-insensitive)"
+    name = Path(path).name.lower()
+    return any(m.lower() in name for m in derived_markers)
+
+def is_datafile(path, datafile_patterns):
+    "True if the file name matches one of the data file patterns. Derived files (see is_derived) never match."
+    name = Path(path).name
+    return not is_derived(name) and any(fnmatch.fnmatch(name, pat) for pat in datafile_patterns)
+
+class EventCoalescer():
+    """Merge bursts of file system events into one notification per sample.
+
+All events (created, modified, moved into the tree, closed) for the files of a sample, or for a
+directory containing samples, are collected until no new events have arrived for window seconds.
+Each sample data file is then passed to on_sample(datafile) once."""
+    def __init__(self, on_sample, datafile_patterns, window=2.0, per_directory=True, max_remembered=100000):
+        self.on_sample = on_sample
+        self.datafile_patterns = datafile_patterns
+        self.window = window
+        self.per_directory = per_directory # One sample per directory, or each data file is a sample
+        self.max_remembered = max_remembered
+        self._samples = {} # sample key: [datafile, time of last event]
+        self._dirs = {} # directory created or moved into the tree: time of last event
+        self._emitted = OrderedDict() # Keys of samples already passed on
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+    def _key(self, datafile): return datafile.parent if self.per_directory else datafile
+    def event(self, path, is_directory=False):
+        "Register an event for a new or changed file or directory (for moves: the destination path)"
+        path = Path(path)
+        now = time.monotonic()
+        with self._lock:
+            if is_directory: 
+                self._dirs[path] = now
+            elif is_datafile(path, self.datafile_patterns):
+                self._samples[self._key(path)] = [path, now]
+            if path.parent in self._dirs: self._dirs[path.parent] = now
+            if self.per_directory and path.parent in self._samples: self._samples[path.parent][1] = now
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="coalescer", daemon=True)
+        self._thread.start()
+    def stop(self):
+        "Stop and pass on samples still collecting events"
+        self._stop.set()
+        if self._thread: self._thread.join()
+        self._flush(float("inf"))
+    def _scan_dir(self, dirpath):
+        found = []
+        for root, dirs, files in os.walk(dirpath):
+            found += [Path(root) / f for f in files if is_datafile(f, self.datafile_patterns)]
+        return found
+    def _emit(self, datafile):
+        key = self._key(datafile)
+        with self._lock:
+            if key in self._emitted:
+                log.debug(f"Sample {key} already passed on, ignoring further events")
+                return
+            self._emitted[key] = True
+            if len(self._emitted) > self.max_remembered: self._emitted.popitem(last=False)
+        self.on_sample(datafile)
+    def _flush(self, age):
+        now = time.monotonic()
+        with self._lock:
+            quiet = [k for k, (datafile, t) in self._samples.items() if now - t >= age]
+            datafiles = [self._samples.pop(k)[0] for k in quiet]
+            dirs = [d for d, t in self._dirs.items() if now - t >= age]
+            for d in dirs: del self._dirs[d]
+        for d in dirs: datafiles += self._scan_dir(d) # Contents of directories moved into the tree produce no events
+        for datafile in datafiles: self._emit(datafile)
+    def _run(self):
+        while not self._stop.is_set():
+            self._flush(self.window)
+            self._stop.wait(min(self.window/4, 0.5))
+
+class PendingSample():
+    "A detected sample waiting for its files to be complete"
+    def __init__(self, datafile, expected):
+        self.datafile = datafile
+        self.expected = expected # Paths of all files that must be present
+        self.detected = time.monotonic()
+        self.signatures = {} # path: (size, mtime) at last check
+        self.stable_since = {} # path: monotonic time since when the signature has not changed
+
+class ReadinessDetector():
+    """Hand detected samples on to on_ready(datafile) once all of their files are complete.
+
+A file is complete when a close-after-write event has been seen for it, or when its size and
+modification time have not changed for settle_time seconds. A sample still incomplete after timeout
+seconds is handed on anyway. Waiting happens in a separate thread, never in the worker threads."""
+    def __init__(self, on_ready, expected_files=(), settle_time=1.0, timeout=60.0, poll_interval=0.25):
+        self.on_ready = on_ready
+        self.expected_files = list(expected_files) # File names relative to the sample directory
+        self.settle_time = settle_time
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._pending = {} # datafile path: PendingSample
+        self._closed = OrderedDict() # path: (size, mtime) when a close-after-write event was seen
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+    @property
+    def pending_count(self): return len(self._pending)
+    def add(self, datafile):
+        "Register a newly detected sample data file"
+        datafile = Path(datafile)
+        expected = [datafile] + [datafile.parent / x for x in self.expected_files if x != datafile.name]
+        with self._lock:
+            if datafile in self._pending:
+                log.debug(f"Sample {datafile} is already waiting for its files")
+                return
+            self._pending[datafile] = PendingSample(datafile, expected)
+        log.debug(f"Waiting for files of sample {datafile} to be complete")
+    def file_closed(self, path, max_remembered=10000):
+        "Record a close-after-write event (available e.g. with inotify on Linux). The sample may not be pending yet."
+        path = Path(path)
+        try: st = os.stat(path)
+        except OSError: return
+        with self._lock:
+            self._closed[path] = (st.st_size, st.st_mtime_ns)
+            if len(self._closed) > max_remembered: self._closed.popitem(last=False)
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="readiness", daemon=True)
+        self._thread.start()
+    def stop(self):
+        "Stop waiting; samples still pending are handed on as they are"
+        self._stop.set()
+        if self._thread: self._thread.join()
+        with self._lock:
+            remaining = list(self._pending)
+            self._pending.clear()
+        for datafile in remaining: self.on_ready(datafile)
+    def _file_complete(self, pending, path, now):
+        try: st = os.stat(path)
+        except OSError: return False  # Not (yet) present
+        sig = (st.st_size, st.st_mtime_ns)
+        if self._closed.get(path) == sig: return True # Closed after writing and not changed since
+        unchanged = pending.signatures.get(path) == sig # Seen with the same size and mtime at the previous poll
+        if not unchanged:
+            pending.signatures[path] = sig
+            pending.stable_since[path] = now
+        if st.st_size == 0: return False
+        # Unchanged long enough, or unchanged since the previous poll and last modified long enough ago (e.g. existing files;
+        # copies keeping the original mtime can still be growing at the first poll)
+        return now - pending.stable_since[path] >= self.settle_time or (unchanged and time.time() - st.st_mtime >= self.settle_time)
+    def _ready(self, pending, now):
+        complete = [self._file_complete(pending, p, now) for p in pending.expected] # Check all to update signatures
+        if all(complete): return True
+        if now - pending.detected >= self.timeout:
+            missing = [str(p) for p, c in zip(pending.expected, complete) if not c]
+            log.warning(f"Files of sample {pending.datafile} not complete after {self.timeout} s, processing anyway. Incomplete: {missing}")
+            return True
+        return False
+    def _run(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+            with self._lock:
+                ready = [d for d, pending in self._pending.items() if self._ready(pending, now)]
+                for datafile in ready: 
+                    for path in self._pending.pop(datafile).expected: self._closed.pop(path, None)
+            for datafile in ready:
+                log.debug(f"Sample {datafile} is ready for processing")
+                self.on_ready(datafile)
+            self._stop.wait(self.poll_interval)
@@ -0,0 +1,77 @@
+"""
+Scheduling of samples waiting for postprocessing.
+
+Newly detected (live) samples are served before backlog samples found by scanning existing data.
+Backlog samples age while they wait, so they are never starved.
+"""
+import logging,  threading,  time,  itertools,  heapq
+
+log = logging.getLogger() # Overwrite if needed
+
+LIVE = "live"
+BACKLOG = "backlog"
+
+class PrioritySampleQueue():
+    """A queue.Queue-like priority queue with two classes of items, LIVE and BACKLOG.
+
+An item's priority is its class base priority minus aging*(seconds waited), lower is served first.
+With the defaults a backlog item waiting longer than 10 minutes is served before a new live item.
+Each class can have its own maximum size (0 = unbounded); put() blocks while the class is full.
+None (the end-of-life marker for workers) is always served last."""
+    def __init__(self, maxsize=None, base_priority=None, aging=1.0):
+        self.maxsize = {LIVE: 0, BACKLOG: 0}
+        self.maxsize.update(maxsize or {})
+        self.base_priority = {LIVE: 0.0, BACKLOG: 600.0}
+        self.base_priority.update(base_priority or {})
+        self.aging = aging # Priority gain per second of waiting, the same for all classes
+        self._items = {LIVE: [], BACKLOG: []} # Per class heaps of (enqueue time, sequence number, item)
+        self._stopmarks = 0
+        self._counter = itertools.count()
+        self._unfinished = 0
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+        self._all_done = threading.Condition(self._mutex)
+    def put(self, item, klass=LIVE):
+        with self._not_full:
+            if item is None:
+                self._stopmarks += 1
+            else:
+                while self.maxsize[klass] and len(self._items[klass]) >= self.maxsize[klass]: self._not_full.wait()
+                heapq.heappush(self._items[klass], (time.monotonic(), next(self._counter), item))
+            self._unfinished += 1
+            self._not_empty.notify()
+    def _pick(self):
+        # Within a class the oldest item has the best priority, so compare only the heads of the classes
+        now = time.monotonic()
+        best = None
+        for klass, items in self._items.items():
+            if not items: continue
+            prio = self.base_priority[klass] - self.aging*(now - items[0][0])
+            if best is None or prio < best[0]: best = (prio, klass)
+        return best[1] if best else None
+    def get(self):
+        "Remove and return the item with the best priority, blocks while the queue is empty"
+        with self._not_empty:
+            while True:
+                klass = self._pick()
+                if klass or self._stopmarks: break
+                self._not_empty.wait()
+            if klass is None:
+                self._stopmarks -= 1
+                return None
+            t, n, item = heapq.heappop(self._items[klass])
+            self._not_full.notify_all()
+            return item
+    def task_done(self):
+        with self._all_done:
+            self._unfinished -= 1
+            if self._unfinished <= 0: self._all_done.notify_all()
+    def join(self):
+        with self._all_done:
+            while self._unfinished: self._all_done.wait()
+    def qsize(self):
+        with self._mutex: return sum(len(x) for x in self._items.values())
+    def depths(self):
+        "Number of waiting items per class"
+        with self._mutex: return {k: len(v) for k, v in self._items.items()}
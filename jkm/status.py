@@ -0,0 +1,43 @@
+"""
+Optional HTTP status endpoint for the postprocessor (monitor mode).
+
+Serves the JSON returned by a status function at http://127.0.0.1:<port>/status, for dashboards and alerts.
+"""
+import logging,  threading,  json
+from http.server import ThreadingHTTPServer,  BaseHTTPRequestHandler
+
+log = logging.getLogger() # Overwrite if needed
+
+class _StatusRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") not in ("", "/status"):
+            self.send_error(404)
+            return
+        try: body = json.dumps(self.server.status_func(), indent=2, default=str).encode("utf8")
+        except Exception as msg:
+            log.error(f"Creating status report failed: {msg}")
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, format, *args): # Requests go to the debug log, not stderr
+        log.debug(f"Status request from {self.address_string()}: {format % args}")
+
+class StatusServer():
+    "HTTP server in a background thread, bound to localhost only"
+    def __init__(self, status_func, port=8089, host="127.0.0.1"):
+        self._server = ThreadingHTTPServer((host, port), _StatusRequestHandler)
+        self._server.daemon_threads = True
+        self._server.status_func = status_func
+        self._thread = None
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="status", daemon=True)
+        self._thread.start()
+        host, port = self._server.server_address[:2]
+        log.info(f"Status available at http://{host}:{port}/status")
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
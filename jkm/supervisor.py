@@ -0,0 +1,147 @@
+"""
+Supervised, crash-isolated worker processes.
+
+Each worker process handles one item (sample) at a time. If a worker dies, e.g. from a segfault in
+native code (zbar, OpenCV, a broken JPEG), or does not finish within a time limit, the item is
+reported as poisoned, the worker is replaced and the remaining items keep moving.
+"""
+import logging,  threading,  time,  multiprocessing
+from multiprocessing.connection import wait
+import jkm.errors
+
+log = logging.getLogger() # Overwrite if needed
+
+def _worker_main(conn, initializer, initargs, target, finalizer=None):
+    "Main loop of a worker process: receive an item, send back ('ok', result) or ('error', message)"
+    if initializer: initializer(*initargs)
+    while True:
+        try: item = conn.recv()
+        except EOFError: break
+        if item is None: break
+        try: reply = ("ok", target(item))
+        except Exception as msg: reply = ("error", f"{type(msg).__name__}: {msg}")
+        conn.send(reply)
+    if finalizer: finalizer()
+
+class _Worker():
+    def __init__(self, context, initializer, initargs, target, n, finalizer=None):
+        self.conn, childconn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(childconn, initializer, initargs, target, finalizer),
+                                       name=f"jkm-worker-{n}", daemon=True)
+        self.process.start()
+        childconn.close()
+        self.item = None # Item being processed, None if idle
+        self.started = None # time.monotonic() when the item was sent
+    def send_stop(self):
+        "Ask the worker to finish"
+        try: self.conn.send(None)
+        except (OSError, ValueError): pass
+    def stop(self, force=False, timeout=5):
+        "Kill the worker, or ask it to finish and kill it only if it has not exited in timeout seconds"
+        if force: self.process.kill()
+        else: self.send_stop()
+        self.process.join(timeout)
+        if self.process.is_alive(): self.process.kill()
+        self.conn.close()
+
+class WorkerSupervisor():
+    """Run target(item) in num_workers supervised child processes.
+
+Callbacks (called from the supervisor thread): on_result(item, result) on success, on_error(item, message)
+if target raised an exception, on_poisoned(item, reason) if the worker crashed or timed out.
+finalizer() is called in each worker process when it is stopped by shutdown(), which waits up to stop_timeout
+seconds for it before killing the process."""
+    def __init__(self, num_workers, target, on_result, on_error, on_poisoned, initializer=None, initargs=(),
+                 timeout=600, context=None, max_idle_deaths=3, finalizer=None, stop_timeout=300):
+        self.num_workers = num_workers
+        self.target = target
+        self.on_result = on_result
+        self.on_error = on_error
+        self.on_poisoned = on_poisoned
+        self.initializer = initializer
+        self.initargs = initargs
+        self.finalizer = finalizer
+        self.stop_timeout = stop_timeout
+        self.timeout = timeout
+        self.context = context or multiprocessing.get_context("spawn")
+        self.max_idle_deaths = max_idle_deaths # Workers dying without an item (e.g. in initializer) before giving up
+        self.broken = False
+        self._idle_deaths = 0
+        self._spawned = 0
+        self._workers = []
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+    def _spawn(self):
+        self._spawned += 1
+        return _Worker(self.context, self.initializer, self.initargs, self.target, self._spawned, self.finalizer)
+    def start(self):
+        with self._cond: self._workers = [self._spawn() for i in range(self.num_workers)]
+        self._thread = threading.Thread(target=self._run, name="supervisor", daemon=True)
+        self._thread.start()
+    def submit(self, item):
+        "Send an item to an idle worker, blocks until one is available"
+        with self._cond:
+            while True:
+                if self.broken: raise jkm.errors.JKError("Worker processes keep failing, cannot process samples")
+                idle = [w for w in self._workers if w.item is None]
+                if idle: break
+                self._cond.wait()
+            worker = idle[0]
+            worker.item = item
+            worker.started = time.monotonic()
+            try: worker.conn.send(item)
+            except OSError: pass # Worker just died, the supervisor thread reports the item as poisoned
+    def shutdown(self):
+        "Wait for items in progress, then stop all workers"
+        with self._cond:
+            while any(w.item is not None for w in self._workers) and not self.broken: self._cond.wait()
+        self._stop.set()
+        if self._thread: self._thread.join()
+        for w in self._workers: w.send_stop()
+        for w in self._workers: w.stop(timeout=self.stop_timeout) # Workers finish (e.g. write queued images) in parallel
+    def _replace(self, worker, reason):
+        "Report the item of a failed worker as poisoned and start a new worker in its place"
+        item = worker.item
+        worker.stop(force=True)
+        with self._cond:
+            self._workers[self._workers.index(worker)] = self._spawn() if not self.broken else worker
+        if item is not None:
+            self._idle_deaths = 0
+            log.error(f"Worker process failed ({reason}) while processing {item}, sample quarantined")
+            self.on_poisoned(item, reason)
+        else:
+            self._idle_deaths += 1
+            log.error(f"Worker process failed ({reason}) without a sample")
+            if self._idle_deaths >= self.max_idle_deaths:
+                log.critical("Worker processes keep failing at start-up, giving up")
+                self.broken = True
+        with self._cond: self._cond.notify_all()
+    def _run(self):
+        while not self._stop.is_set():
+            with self._cond: workers = list(self._workers)
+            waitables = {}
+            for w in workers:
+                if w.process.is_alive() or w.item is not None:
+                    waitables[w.conn] = waitables[w.process.sentinel] = w
+            ready = wait(list(waitables), timeout=0.5)
+            now = time.monotonic()
+            for w in {waitables[x] for x in ready} | {w for w in workers if not w.process.is_alive()}:
+                if w not in self._workers: continue # Already replaced
+                reply = None
+                try:
+                    if w.conn.poll(): reply = w.conn.recv()
+                except (EOFError, OSError): pass
+                if reply is not None:
+                    item = w.item
+                    with self._cond:
+                        w.item = None
+                        self._cond.notify_all()
+                    status, value = reply
+                    if status == "ok": self.on_result(item, value)
+                    else: self.on_error(item, value)
+                elif not w.process.is_alive() and not self.broken:
+                    self._replace(w, f"exit code {w.process.exitcode}")
+            for w in workers:
+                if w.item is not None and w in self._workers and now - w.started > self.timeout:
+                    self._replace(w, f"no result in {self.timeout} s")
@@ -0,0 +1,86 @@
+"""
+Windowed reading of very large images: regions at a chosen resolution without decoding the whole image.
+
+Uncompressed TIFF files are memory-mapped, tiled or striped compressed TIFF files are read through zarr,
+so only the tiles overlapping a window are decoded. Both need the optional tifffile package (and zarr).
+Other files (e.g. JPEG) are decoded at the lowest sufficient resolution (see jkm.tools.load_img) and cropped.
+"""
+import logging,  contextlib
+from pathlib import Path
+import cv2
+import numpy as np
+import jkm.tools
+from jkm.errors import FileLoadingError
+try: import tifffile
+except ImportError: tifffile = None
+try: import zarr
+except ImportError: zarr = None
+
+log = logging.getLogger() # Overwrite if needed
+tiff_suffixes = (".tif", ".tiff")
+
+class WindowReader():
+    """Reads windows of one image file.
+
+size is (width, height) of the full image, or None if unknown before decoding. windowed is True if windows
+are read without decoding the whole image."""
+    def __init__(self, fn):
+        self.fn = Path(fn)
+        self.size = None
+        self.windowed = False
+        self._mode = "decode"
+        if self.fn.suffix.lower() in tiff_suffixes and tifffile:
+            try: self._open_tiff()
+            except Exception as msg: log.debug(f"Cannot read {self.fn} in windows: {msg}")
+    def _open_tiff(self):
+        with tifffile.TiffFile(self.fn) as tif:
+            page = tif.pages[0]
+            self.size = (page.imagewidth, page.imagelength)
+            if page.is_memmappable: self._mode = "memmap"
+            elif zarr and (page.is_tiled or page.rowsperstrip < page.imagelength): self._mode = "zarr"
+        self.windowed = self._mode != "decode"
+    @contextlib.contextmanager
+    def _array(self):
+        "The whole image as a lazily read array-like object, the file is closed when the with block ends"
+        if self._mode == "memmap":
+            arr = tifffile.memmap(self.fn, page=0, mode="r")
+            try: yield arr
+            finally: del arr # Unmaps the file (no views are kept)
+        else:
+            with tifffile.imread(self.fn, key=0, aszarr=True) as store: yield zarr.open(store, mode="r")
+    def read(self, rect=None, scale=1.0, grayscale=False):
+        """Returns the window rect = (x1, y1, x2, y2) in full image coordinates (None = whole image),
+scaled by scale (at most 1), as BGR(A) or greyscale like cv2.imread."""
+        if not self.windowed: return self._read_decoded(rect, scale, grayscale)
+        w, h = self.size
+        x1, y1, x2, y2 = rect[:4] if rect else (0, 0, w, h)
+        x1, y1, x2, y2 = max(0, int(x1)), max(0, int(y1)), min(w, int(x2)), min(h, int(y2))
+        step = max(1, int(1/scale)) # Subsample while reading, only the rest is done by resizing
+        try:
+            with self._array() as arr: img = np.array(arr[y1:y2:step, x1:x2:step]) # A copy, so that the file is not kept open
+        except Exception as msg: raise FileLoadingError(f"Reading a window of {self.fn} failed: {msg}")
+        img = _to_opencv(img, grayscale)
+        return _resize_to(img, (x2-x1)*scale, (y2-y1)*scale)
+    def _read_decoded(self, rect, scale, grayscale):
+        reduction = next((r for r in (8, 4, 2) if scale <= 1/r), 1)
+        img = jkm.tools.load_img(self.fn, reduction, grayscale)
+        if rect:
+            x1, y1, x2, y2 = (int(c/reduction) for c in rect[:4])
+            img = img[y1:y2, x1:x2]
+        return _resize_to(img, img.shape[1]*scale*reduction, img.shape[0]*scale*reduction)
+
+def _to_opencv(img, grayscale):
+    "tifffile gives RGB(A) channel order, OpenCV uses BGR(A)"
+    if img.ndim == 3 and img.shape[2] in (3, 4):
+        img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR if img.shape[2] == 3 else cv2.COLOR_RGBA2BGRA)
+    return jkm.tools.to_grey(img) if grayscale and img.ndim == 3 else img
+
+def _resize_to(img, w, h):
+    w, h = max(1, round(w)), max(1, round(h))
+    if img.shape[1] == w and img.shape[0] == h: return img
+    return cv2.resize(img, (w, h), interpolation=cv2.INTER_AREA)
+
+def window_reader(fn):
+    "A WindowReader for fn if its windows can be read without decoding the whole image, otherwise None"
+    reader = WindowReader(fn)
+    return reader if reader.windowed else None
@@ -1,4 +1,4 @@
-import time,  logging,  ast,  math,  re,  io
+import time,  logging,  ast,  math,  re,  io,  mmap
 from pathlib import Path
 from shutil import disk_usage
 import numpy as np
@@ -59,24 +59,112 @@ def shrink_to_maxdim(img,maxdim):
     scale = min(1.0, maxdim/md)
     return cv2.resize(img,(0,0),fx=scale,fy=scale)
     
+def to_grey(img):
+    "Greyscale version of a BGR(A) image, greyscale images are returned as they are"
+    if img.ndim == 2: return img
+    return cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY if img.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
+
+deg2rotcode = {90: cv2.ROTATE_90_CLOCKWISE,
+               180: cv2.ROTATE_180,
+               270: cv2.ROTATE_90_COUNTERCLOCKWISE}
+
+def rotate_img(img, angle):
+    "Rotate clockwise by 0, 90, 180 or 270 degrees"
+    return cv2.rotate(img, rotateCode = deg2rotcode[angle]) if angle else img
+
+def unrotate_rect(rect, angle, w, h):
+    """Map a rectangle (x1,y1,x2,y2,...) in an image rotated clockwise by angle to the unrotated image of size w x h.
+
+Coordinates are clipped to the image, further items of rect (e.g. a text angle) are kept."""
+    x1, y1, x2, y2 = rect[:4]
+    if angle == 90: x1, y1, x2, y2 = y1, h-x2, y2, h-x1
+    elif angle == 180: x1, y1, x2, y2 = w-x2, h-y2, w-x1, h-y1
+    elif angle == 270: x1, y1, x2, y2 = w-y2, x1, w-y1, x2
+    clip = lambda v, top: int(min(max(v, 0), top))
+    return (clip(x1, w), clip(y1, h), clip(x2, w), clip(y2, h)) + tuple(rect[4:])
+
 def save_img(fn,image): # Better error handling than the raw cv2 imwrite
     if isinstance(fn,Path): fn = str(fn)
     try: cv2.imwrite(fn,image)
     except SystemError as err: raise err
 
-def load_img(image): #Loads image from image object or file
+# cv2.imread flags decoding JPEG files directly at 1/2, 1/4 or 1/8 resolution (other formats are decoded and resized)
+_reduced_colour = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+_reduced_grey = {2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+_jpeg_sof = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC} # Start of frame markers (not DHT, JPG, DAC)
+read_with_mmap = False # Default for load_img: decode files through a memory map instead of cv2.imread
+
+def jpeg_size(fn):
+    "Returns (width, height) of a JPEG file read from its header, None if fn is not a readable JPEG file. fn may also be the file contents."
+    try:
+        with (open(fn, "rb") if isinstance(fn, (str, Path)) else io.BytesIO(memoryview(fn)[:2**18])) as f: # Headers only
+            if f.read(2) != b"\xff\xd8": return None
+            while True:
+                marker = f.read(2)
+                while len(marker) == 2 and marker[1] == 0xFF: marker = marker[1:] + f.read(1) # Fill bytes
+                if len(marker) < 2 or marker[0] != 0xFF: return None
+                seglen = f.read(2)
+                if len(seglen) < 2: return None
+                if marker[1] in _jpeg_sof:
+                    data = f.read(5)
+                    if len(data) < 5: return None
+                    return (int.from_bytes(data[3:5], "big"), int.from_bytes(data[1:3], "big"))
+                f.seek(int.from_bytes(seglen, "big") - 2, io.SEEK_CUR)
+    except OSError: return None
+
+def reduction_for(fn, min_dim):
+    """Largest JPEG decoding reduction (1, 2, 4 or 8) keeping the longer image side at least min_dim pixels.
+
+Returns 1 for other file types and if min_dim is not given."""
+    size = jpeg_size(fn) if min_dim else None
+    if not size: return 1
+    return next((r for r in (8, 4, 2) if max(size)/r >= min_dim), 1)
+
+def _frombuffer(data):
+    "Wraps encoded image data supporting the buffer protocol as a 1-D uint8 array, without copying"
+    if isinstance(data, np.ndarray): return data if data.dtype == np.uint8 else data.view(np.uint8)
+    return np.frombuffer(data, np.uint8)
+
+def _decode_mmap(fnp, flags):
+    "Decode a file through a read-only memory map: no copy of the file data in the Python process"
+    with open(fnp, "rb") as f:
+        try: mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: return None # Empty file
+    with mm:
+        buf = np.frombuffer(mm, np.uint8)
+        try: return cv2.imdecode(buf, flags)
+        finally: del buf # Release the buffer before the map is closed
+
+def load_img(image, reduce=1, grayscale=False, use_mmap=None): #Loads image from image object or file
+    """Load an image from a file name, a file object, encoded image data or an image array.
+
+Encoded data (bytes, bytearray, memoryview, mmap, io.BytesIO or a 1-D uint8 numpy array) is decoded without copying.
+Files are read with cv2.imread, or through a memory map if use_mmap (default: module variable read_with_mmap).
+Files and encoded data can be decoded at reduced resolution (reduce = 2, 4 or 8, see reduction_for) and/or as greyscale,
+which for JPEG files is much faster than a full decode. Image arrays are returned as they are."""
     # Todo: add better Error handling (catch SystemError from and convert from FileError or like)
+    if reduce in _reduced_colour: flags = (_reduced_grey if grayscale else _reduced_colour)[reduce]
+    else: flags = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_UNCHANGED
+    # Like IMREAD_UNCHANGED (full decode) and jpeg_size, never apply EXIF orientation: all levels share one coordinate frame
+    if flags != cv2.IMREAD_UNCHANGED: flags |= cv2.IMREAD_IGNORE_ORIENTATION
     if isinstance(image,str)or isinstance(image,Path):
         fnp = Path(image)
         if not fnp.exists(): raise FileLoadingError("File %s does not exist" % fnp)
         if not fnp.is_file(): raise FileLoadingError("%s is not a file" % fnp)
         if fnp.is_reserved(): raise FileLoadingError("File %s is reserved" % fnp)
-        img = cv2.imread(str(fnp),cv2.IMREAD_UNCHANGED)
+        if (read_with_mmap if use_mmap is None else use_mmap): img = _decode_mmap(fnp, flags)
+        else: img = cv2.imread(str(fnp),flags)
+    elif isinstance(image, (bytes, bytearray, memoryview, mmap.mmap)) or (isinstance(image, np.ndarray) and image.ndim == 1):
+        img = cv2.imdecode(_frombuffer(image),flags)
+    elif isinstance(image, io.BytesIO):
+        img = cv2.imdecode(_frombuffer(image.getbuffer()),flags)
     elif isinstance(image, io.IOBase):
-        img = cv2.imdecode(image.read(),cv2.IMREAD_UNCHANGED)
+        img = cv2.imdecode(_frombuffer(image.read()),flags)
     else:
         img = image # This is hopefully already a Image-type object ... test for numpy.ndarray ?    
-    if img is None: raise FileLoadingError("Loading file %s failed, reason not known" % image) 
+    if img is None: 
+        source = image if isinstance(image,(str,Path)) else type(image).__name__ # Do not print encoded data
+        raise FileLoadingError("Loading file %s failed, reason not known" % source) 
     return img
 
 def increaseTopContrast(image,greyrange):
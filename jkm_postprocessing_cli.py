@@ -1,23 +1,31 @@
 # Check: Watchdog in licences using the Apache License, Version 2.0 
 # TODO: ADD ATEXIT CALL TO CLOSE LOG FILES ON CRASH
-import time,  logging,  threading, sys
-from datetime import datetime
+import time,  logging,  logging.handlers,  threading, sys,  os
 from pathlib import Path
-import queue
+import multiprocessing,  functools
 # non-stdlib modules
 from watchdog.observers import Observer
 import watchdog.events
 # app-specific modules
-import jkm.configfile,  jkm.sample,  jkm.tools,  jkm.errors,  jkm.barcodes, jkm.ocr_analysis
+import jkm.configfile,  jkm.sample,  jkm.tools,  jkm.errors,  jkm.barcodes, jkm.ocr_analysis,  jkm.postprocessor,  jkm.pipeline,  jkm.samplewatch,  jkm.ledger,  jkm.scheduling,  jkm.metrics,  jkm.status,  jkm.supervisor,  jkm.prefetch,  jkm.derivatives
 
 _debug = False    
-_num_worker_threads = 1
+_num_worker_threads = 1 # In-process worker threads, used when [postprocessor] workers is 1
+_table_lock = threading.Lock() # Serialises writes to the CSV output table
+ledger = None # jkm.ledger.ProcessingLedger, set up in main
+_finished_statuses = (jkm.ledger.STATUS_DONE, jkm.ledger.STATUS_POISONED) # Samples not queued again
+quarantine_file = None # List of samples that crashed or hung a worker process, set up in main
+_scan_stop = threading.Event() # Stops queueing existing samples
+_claimed = set() # Samples queued or being processed
+_claim_lock = threading.Lock()
+metrics = jkm.metrics.MetricsRegistry() # Stage timings and sample counts of this session
+recent_errors = jkm.metrics.RecentErrorsHandler() # Latest warnings and errors, for the status endpoint
+detector = None # jkm.samplewatch.ReadinessDetector, used in monitor mode
+prefetcher = None # jkm.prefetch.Prefetcher reading queued samples ahead, if enabled
 _program_name = "jkm-post"
 _program_ver = "1.3a" 
 _program = f"{_program_name} ({_program_ver})"
 
-def _UNIQUE(s) :return tuple(set(s))
-
 def quit_if_not_exists(pathname):
     if not pathname.exists():
         log.critical(f"Path {pathname} not found. Quitting.")
@@ -25,211 +33,225 @@ def quit_if_not_exists(pathname):
 
 # Move to Luomus-specific Sample type
 def find_samples(dirname,datafile_patterns):
-    #This just returns a list of matching file names
-    log.debug(f"Finding '{datafile_patterns}' files to process if {dirname}" )
-    d = Path(dirname) 
-    result = []
-    for pat in datafile_patterns: 
-        tempr = d.rglob(pat)
-        log.debug(f"Looking for pattern {pat} in {dirname}")
-        tempr = [x for x in tempr if ( str(x).find("textarea") == -1 )] # Skip files with "textarea" in their name
-        result.extend( tempr )
-    # Delete duplicate files (hard links to the same file)
-    return _UNIQUE(result)
+    """Walk the directory tree, yielding (Path, os.stat_result) for each matching file as soon as it is found.
 
+Files with "textarea" in their name are skipped. Hard links to the same file are yielded only once."""
+    log.debug(f"Finding '{datafile_patterns}' files to process in {dirname}" )
+    seen = set() # (st_dev, st_ino) of files already yielded
+    dirs = [str(dirname)]
+    while dirs:
+        try: entries = os.scandir(dirs.pop())
+        except OSError as msg:
+            log.warning(f"Cannot read directory: {msg}")
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False): 
+                        dirs.append(entry.path)
+                        continue
+                    if not jkm.samplewatch.is_datafile(entry.name, datafile_patterns): continue # Also skips derived images (text area crops etc.)
+                    st = entry.stat()
+                    if st.st_ino == 0: st = os.stat(entry.path) # DirEntry.stat() does not set inode numbers on Windows
+                except OSError as msg:
+                    log.warning(f"Cannot access {entry.path}: {msg}")
+                    continue
+                if (st.st_dev, st.st_ino) in seen: continue
+                seen.add((st.st_dev, st.st_ino))
+                yield Path(entry.path), st
 
-class myFileEventHandler(watchdog.events.PatternMatchingEventHandler):
-    _lastinsert = None
-    def __init__(self,  *args,  **kwargs): super().__init__(*args,**kwargs)
-    def on_created(self, event): 
-        if event.src_path != self._lastinsert: q.put(event.src_path)
-        else: log.debug(f"Prevented double insertion of {event.src_path} into the queue")
-        self._lastinsert = event.src_path        
+def queueExistingSamples(dirname, datafile_patterns, reprocess=False):
+    "Queue existing samples as they are found, skipping those already in the processing ledger. Blocks while the queue is full."
+    found = skipped = 0
+    for fn, st in find_samples(dirname, datafile_patterns):
+        if _scan_stop.is_set(): break
+        found += 1
+        if not reprocess and ledger.is_done(fn, (st.st_size, st.st_mtime_ns), _finished_statuses): skipped += 1
+        else: enqueue(fn, check_ledger=False, klass=jkm.scheduling.BACKLOG)
+    log.info(f"Found {found} existing sample events, skipped {skipped} already in the processing ledger (use --reprocess to process them again)")
+
+
+class myFileEventHandler(watchdog.events.FileSystemEventHandler):
+    "Passes all file system events to a jkm.samplewatch.EventCoalescer, close-after-write events also to a ReadinessDetector"
+    def __init__(self, coalescer, detector, *args,  **kwargs): 
+        super().__init__(*args,**kwargs)
+        self.coalescer = coalescer
+        self.detector = detector
+    def on_created(self, event): self.coalescer.event(event.src_path, event.is_directory)
+    def on_modified(self, event): 
+        if not event.is_directory: self.coalescer.event(event.src_path)
+    def on_moved(self, event): # e.g. files copied under a temporary name, or directories moved into the tree
+        self.coalescer.event(event.dest_path, event.is_directory)
+    def on_closed(self, event): # inotify only
+        self.coalescer.event(event.src_path)
+        self.detector.file_closed(event.src_path)
 
 def path_in_list(p,pathlist):
     for p2 in pathlist: 
         if p.samefile(p2): return True
     return False		
     
-# ----------------- main worker function ------------------------
-def processSampleEvents(conf, sleep_s, data_out_table):
+# ----------------- main worker functions ------------------------
+def enqueue(fn, check_ledger=True, klass=jkm.scheduling.LIVE):
+    "Queue a sample unless it is already queued or being processed, or (if check_ledger) already in the processing ledger"
+    key = str(Path(fn))
+    if check_ledger and ledger.is_done(fn, statuses=_finished_statuses): # e.g. a directory renamed by this program after processing
+        log.debug(f"Sample {fn} has already been processed, not queueing it again")
+        return
+    with _claim_lock:
+        if key in _claimed:
+            log.debug(f"Sample {fn} is already queued or being processed")
+            return
+        _claimed.add(key)
+    q.put(fn, klass)
+
+def release(fn):
+    "Allow a sample to be queued again after processing it"
+    with _claim_lock: _claimed.discard(str(Path(fn)))
+
+def status_report():
+    "Current state of the postprocessor, served by the HTTP status endpoint"
+    depths = q.depths()
+    with _claim_lock: claimed = len(_claimed)
+    stats = metrics.as_dict()
+    return {"program": _program, "uptime_s": stats["uptime_s"], "queue": depths, 
+            "in_flight": max(0, claimed - sum(depths.values())), # Taken from the queue but not finished
+            "waiting_for_files": detector.pending_count if detector else 0,
+            "prefetched": prefetcher.waiting if prefetcher else 0,
+            "samples": stats["samples"], "samples_per_s": stats["samples_per_s"], 
+            "latency_s": metrics.latencies(), "recent_errors": recent_errors.recent()}
+
+def store_result(result, data_out_table):
+    "Store interpreted data of a processed sample in the table file and the ledger. Only called in the main process."
+    if result and result.ocrdata and data_out_table:
+        with _table_lock:
+            log.debug(f"{result.name}: Calling OutputCSV.addline with data: {result.ocrdata}")
+            data_out_table.add_line(result.ocrdata)
+    if result and ledger:
+        status = jkm.ledger.STATUS_DONE if result.processed else jkm.ledger.STATUS_FAILED
+        ledger.record(result.final_filename or result.filename, status, result.as_dict())
+    if result: metrics.add_sample(result.timings, "done" if result.processed else "skipped", result.counts)
+    else: metrics.add_sample({}, "error")
+    log.info(f"Sample events in process queue: {q.depths()}\n\n")
+
+def next_sample():
+    "Returns (data file name, image data read ahead or None) of the next sample in the queue, blocks while the queue is empty"
+    if prefetcher: return prefetcher.get()
+    return q.get(), None
+
+def processSampleEvents(conf, data_out_table):
+    "Worker thread processing samples in the main process"
     while True:
         # Input queue = name of file found by the directory watcher tool
-        input = q.get()
+        input, data = next_sample()
         if input is None: break
-        filename = Path(input)
-        time.sleep(sleep_s) # Wait for all data to arrive
-        if not filename.exists():  #" File may aleady have been deleted, renamed etc.
-            log.warning(f"Could not find file {filename}, skipping")
+        result = None
+        try: result = jkm.postprocessor.process_sample(conf, input, data)
+        except Exception as msg: # Recorded as an error, the thread goes on with the next sample
+            log.exception(f"Processing sample {input} failed")
+            if ledger: ledger.record(input, jkm.ledger.STATUS_FAILED, {"error": f"{type(msg).__name__}: {msg}"})
+        finally:
+            store_result(result, data_out_table)
+            release(input)
             q.task_done()
-            continue
-        log.debug(f"Processing data file {filename}" )
-        # Create SampleEvent instances based on (meta)data file(s)
-        #Recognise type to load
-        sample_format = conf.get("sampleformat", "datatype_to_load")        
-        try:
-            dirpath= filename.parent
-            if not dirpath.is_dir():
-                log.warning(f"Cannot find path {dirpath},  skipping to next sample")
-                continue
-            if sample_format.lower() == "mzh_insectline": 
-                sample = jkm.sample.LuomusInsectLineSample.from_directory(dirpath, conf)
-            if sample_format.lower() ==  "mzh_plantline": 
-                sample = jkm.sample.LuomusPlantLineSample.from_directory(dirpath, conf)
-            elif sample_format.lower() == "singlefile":
-                sample = jkm.sample.SingleImageSample.from_image_file(filename, conf, "generic_camera")
-            else:
-                raise jkm.errors.FileLoadingError(f"Unknown sample file/directory format {sample_format}")
-        except jkm.errors.FileLoadingError:
-                q.task_done(); continue
-                
-        # MAIN POSTPROCESSOR STARTS HERE
-        # TODO: CHECK IF THIS WORKS WITH THE REIMPLEMENTED sample
-        log.info(f"Postprocessing sample {sample.name}")
-        # ROTATE
-        rot = conf.geti( "postprocessor", "rotate_before_processing")
-        if rot: # non-zero value
-            for image in sample.imagelist:
-                log.debug(f"{sample.name}: Rotating image {image.name}")
-                image.rotate(rot)
-        # SAVE ROTATED (NOT IMPLEMENTED)
-        
-        # FIND BARCODES
-        allbkdata = []
-        if conf.getb( "postprocessor", "read_barcodes"):
-            barcodepackage = conf.get( "barcodes", "barcodepackage").lower()
-            for image in sample.imagelist:
-                try:
-                    # NOTE: the choice of barcose detector tool is hardcoded in jkm/barcodes.py
-                    bkdata = image.readbarcodes(barcodepackage)
-                    image.meta.addlog("Barcode contents", bkdata, log_add_hdr= sample.name)
-                    allbkdata += bkdata
-                except jkm.errors.FileLoadingError as msg:
-                    log.warning(f"{sample.name}: Barcode detection attempt failed: %s" % msg)
-                    continue
-                    
-        # FIND TEXT ARES
-        if conf.getb( "postprocessor", "find_text_areas"):
-            for image in sample.imagelist:
-                if not image.has_labels : continue # Skip pure specimen images
-                log.debug(f"Searching for text areas in {image.label} of sample {sample.name}")
-                neuralnet = conf.get( "ocr", "EASTfile")
-                textareas = image.findtextareas(neuralnet)
-                image.meta.addlog("Text areas found", str(textareas),  log_add_hdr= sample.name)
-                if conf.getb( "postprocessor", "save_text_area_images"): 
-                    image.savetextareas("_textarea_")
-
-        # PERFORM OCR
-        alltext = ""
-        if conf.getb( "postprocessor", "ocr"):
-            ocr_command = conf.get("ocr", "ocr_command")
-            for image in sample.imagelist:
-                if not image.has_labels : continue # Skip pure specimen images
-                labeltxt = image.ocr(ocr_command) # Default ocr uses fragments created above
-                alltext  += " " + labeltxt
-#                image.meta.addlog("OCR result for image", labeltxt,lvl=logging.DEBUG)
-            sample.meta.addlog("Combined OCR result for all images",alltext,  log_add_hdr= sample.name)
 
-        # EXTRACT IDENTIFIERS FROM OCR DATA (NOT IMPLEMENTED)
+def quarantine(fn, reason):
+    "Mark a sample that crashed or hung a worker process as poisoned, so that it is not processed again"
+    if ledger: ledger.record(fn, jkm.ledger.STATUS_POISONED, {"reason": reason})
+    try:
+        with open(quarantine_file, "a", encoding="utf8") as f: f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')}\t{fn}\t{reason}\n")
+    except OSError as msg: log.error(f"Cannot write to quarantine file {quarantine_file}: {msg}")
+    metrics.add_sample({}, "poisoned")
 
-        # SUBMIT alltext to COMPONENT ANALYSIS
-        # if conf.getb( "postprocessor", "ocr") and conf.getb( "postprocessor", "ocr_analysis"):
-            # ocrdata = jkm.ocr_analysis.ocr_analysis_Luomus(alltext)
-            # log.debug(f"{sample.name}: OCR data parsing output: {ocrdata}")
-        # else: log.debug(f"{sample.name}: No OCR data parsing attempted.")           
-        # SIMPLE IMPLEMENTATION FOR TESTING
-        cleantext = jkm.ocr_analysis.cleanup(alltext)
-        ocrdata = jkm.ocr_analysis.OCRAnalysisResult()
-        ocrdata.append("ocr",cleantext)
-
-         # FOR FURTHER PROCESSING, CHECK IF IDENTIFIER LIST CONTAINS A SINGLE VALID IDENTIFIER
-        # In case sample does already have a known identifier, append to to the list
-        if sample.identifier: allbkdata.append(sample.identifier)
-        sampleids = _UNIQUE(allbkdata)
-        if len(sampleids) == 0:
-            log.warning("No usable identifiers found")
-        elif len(sampleids) > 1:
-            log.warning("Several  different identifiers for the sample in barcodes/OCR/sample metadata")
-        else: sample.identifier =  sampleids[0] # Sets also sample.shortidentifier
-        
-       # Store interpreted data in a table file IF data and identifier are available
-        if sample.identifier and data_out_table:
-            ocrdata.prepend("identifier", sample.identifier) 
-            log.debug(f"{sample.name}: Calling OutputCSV.addline with data: {ocrdata}")
-            log.debug(f"{sample.name}: data_out_table.fp = {data_out_table.fp}")
-            data_out_table.add_line(ocrdata)
-            log.debug(f"{sample.name}: ...done")
-            
-        # RENAME DIRECTORIES (this may need to stay above file renaming)
-        if conf.getb( "basic", "directories_rename_by_barcode_id") and sample.identifier:
-            prefix = sample.datapath.name # last element of directory path
-            log.debug("Renaming directory based on barcode content")
-            try:            
-                sample.rename_directories(conf,prefix)
-            except (jkm.errors.JKError, FileNotFoundError) as msg: 
-                log.warning(f"Renaming directory failed: {msg}. Maybe it has already been renamed.")                
+def build_supervisor(conf, data_out_table, num_workers, context, initargs):
+    "Create a jkm.supervisor.WorkerSupervisor processing samples in crash-isolated worker processes"
+    def finished(input):
+        release(input)
+        q.task_done()
+    def on_result(input, result):
+        try: store_result(result, data_out_table)
+        finally: finished(input)
+    def on_error(input, msg):
+        log.error(f"Processing sample {input} failed in a worker process: {msg}")
+        try: store_result(None, data_out_table)
+        finally: finished(input)
+    def on_poisoned(input, reason):
+        try: quarantine(input, reason)
+        finally: finished(input)
+    return jkm.supervisor.WorkerSupervisor(num_workers, jkm.postprocessor.run_sample, on_result, on_error, on_poisoned, 
+        initializer=jkm.postprocessor.init_worker, initargs=initargs, finalizer=jkm.postprocessor.close_worker,
+        timeout=conf.getf("postprocessor", "worker_timeout", fallback=600), context=context)
 
-        # RENAME FILES
-        # Current implementation renames only the original image files as per the configuration file
-        if conf.getb( "basic", "files_rename_by_barcode_id") and sample.shortidentifier:
-            try:
-                sample.rename_all_files(sample.shortidentifier)
-            except (jkm.errors.JKError, FileNotFoundError) as msg:
-                log.warning(f"Renaming files failed: {msg}.")                
+def dispatchSampleEvents(supervisor):
+    "Feed samples from the queue to supervised worker processes, one sample per idle worker"
+    while True:
+        input, data = next_sample() # Data read ahead stays in the OS file cache for the worker process
+        if input is None: break
+        try: supervisor.submit(str(input)) # Blocks until a worker is idle, so the rest of the queue stays in q
+        except jkm.errors.JKError as msg:
+            log.error(f"Sample {input} not processed: {msg}")
+            release(input)
+            q.task_done()
 
-        # Write records to JSON Metadata file (should this be before renaming?)
-        if conf.getb( "basic", "save_JSON"): sample.writeMetaJSON()
+def feedPipeline(pipeline):
+    "Move samples from the queue to the first stage of a staged pipeline"
+    while True:
+        input, data = next_sample()
+        if input is None: break
+        pipeline.put(jkm.postprocessor.SampleJob(input, data)) # Blocks while the decode stage queue is full
 
-        # FOR MZH IMAGING LINE SAMPLES
-        if conf.get("sampleformat", "datatype_to_load").lower()  in ["mzh_insectline", "mzh_plantline"]:
-            # Write postprocessor.properties file 
-            sample.digipropfile.setheader( f"# {datetime.now()}" )
-            sample.digipropfile.update("full_barcode_data",sample.identifier or "")
-            sample.digipropfile.update("identifier",sample.shortidentifier  or "")
-            sample.digipropfile.update("timestamp",sample.original_timestamp())
-            if sample.identifier: # Only one identifier-containing barcode was found
-                id_OK = sample.verify_identifier()
-                if not id_OK: 
-                    log.critical(f"{sample.name}: *******\n\n\n\nMALFORMED IDENTIFIER {sample.identifier}*******\n\n\n\n")
-                sample.digipropfile.update("URI_format_OK", str(id_OK) )
-            sample.digipropfile.update("Q-sharp", "" )
-            sample.digipropfile.update("Q-color", "" )
-            if conf.getb( "postprocessor", "ocr"): 
-                sample.digipropfile.update("OCR_result", alltext.replace("\n"," "))
-            sample.digipropfile.save( sample.datapath /  Path(r"postprocessor.properties") )
-        #DONE
-        log.info(f"Sample events in process queue: {q.qsize()}\n\n") # Queue still contains this item, thus -1 in the number reported
-           
+def build_pipeline(conf, data_out_table):
+    "Create a jkm.pipeline.Pipeline running the postprocessing stages, each with its own worker count"
+    stage_workers = conf.getlist("postprocessor", "stage_workers", fallback="{}")
+    maxsize = conf.geti("postprocessor", "stage_queue_size", fallback=4)
+    def job_finished(job):
+        job.result.timings["total"] = time.perf_counter() - job.created # Including waiting between stages
+        try: store_result(job.result, data_out_table)
+        finally: 
+            release(job.filename)
+            q.task_done()
+    stages = [jkm.pipeline.Stage(name, functools.partial(func, conf), stage_workers.get(name, 1), maxsize) 
+              for name, func in jkm.postprocessor.STAGES]
+    for stage in stages: log.debug(f"Pipeline stage {stage.name}: {stage.workers} worker(s)")
+    return jkm.pipeline.Pipeline(stages, on_finished=job_finished)
 
 if __name__ == '__main__':
     threads = []
+    supervisor = loglistener = pipeline = scanner = metricswriter = statusserver = None
     excel = None
-    q = queue.Queue() # a FIFO queue of metafile names
     log = jkm.tools.setup_logging(_program_name, debug = _debug)
+    log.addHandler(recent_errors)
     # Set loggers in other modules
-    jkm.configfile.log = log    
-    jkm.tools.log = log
-    jkm.ocr.log = log  # IF OCR
-    jkm.sample.log = log
-    jkm.metadata.log = log
-    jkm.barcodes.log = log
+    jkm.postprocessor.set_module_loggers(log)
+    jkm.pipeline.log = log
+    jkm.samplewatch.log = log
+    jkm.ledger.log = log
+    jkm.scheduling.log = log
+    jkm.metrics.log = log
+    jkm.status.log = log
+    jkm.supervisor.log = log
+    jkm.prefetch.log = log
     
     log.info(f"STARTING NEW SESSION of {_program}")
     # Read config file name from sys.argv and parse the file
     try: 
         conf = jkm.configfile.load_configuration(_program_name) 
-        # Wait period from file detection to file processing
-        # Allows for enough time for transfer of a file(s)  to be completed
-        sleep_s_before_reading_file = conf.getf("postprocessor", "sleep_after_new_sample_detected")
+        # Maximum wait from file detection to file processing, samples are processed as soon as their files are complete
+        max_wait_s = conf.getf("postprocessor", "sleep_after_new_sample_detected")
+        settle_s = conf.getf("postprocessor", "file_settle_time", fallback=1.0)
         # TODO: get data types to process from config file: event packages (identified by metadata files) or simple image files
         #datatype = conf.get("sampleformat", "datatype_to_load")
         filename_pattern = conf.get("sampleformat", "recognize_by_filename_pattern")        
         datafile_patterns = [filename_pattern]
-        if conf.getb("postprocessor", "process_existing"):
-            # Find list of file names matching a pattern and put them into the queue
-            existingevents = find_samples( conf.basepath,datafile_patterns )
-            for fn in existingevents: q.put(fn)
-            log.info(f"Approximate number of sample events to process at launch is {q.qsize()}")
+        jkm.samplewatch.derived_markers += [f"_{name}." for name in jkm.postprocessor.derivative_sizes(conf)] # Thumbnails etc. are not samples
+        # A priority queue of metafile names: new samples first, then existing ones.
+        # The backlog part is bounded, which keeps memory use flat however many existing samples there are
+        q = jkm.scheduling.PrioritySampleQueue(
+            maxsize = {jkm.scheduling.BACKLOG: conf.geti("postprocessor", "queue_size", fallback=1000)}, 
+            base_priority = {jkm.scheduling.BACKLOG: conf.getf("postprocessor", "backlog_max_delay", fallback=600)})
+        ledger = jkm.ledger.ProcessingLedger(conf.get("postprocessor", "ledger_file", fallback=f"{_program_name}-ledger.sqlite"), 
+                                             jkm.postprocessor.config_hash(conf))
+        quarantine_file = conf.get("postprocessor", "quarantine_file", fallback=f"{_program_name}-quarantine.txt")
         
         if conf.getb("postprocessor", "ocr_analysis_to_Excel"):
             ocr_outfile = conf.get("ocr","ocr_analysis_Excel_file")
@@ -238,18 +260,72 @@ if __name__ == '__main__':
             data_out_table.open()
         else: data_out_table = None
         log.debug(f'Using QR code decoder {conf.get( "barcodes", "barcodepackage")}')
+        jkm.postprocessor.configure_modules(conf) # Worker processes configure their own
+        metrics.min_elapsed = conf.getf("postprocessor", "metrics_interval", fallback=15)
+        if conf.has_option("postprocessor", "metrics_file") or conf.has_option("postprocessor", "stats_file"):
+            metricswriter = jkm.metrics.MetricsWriter(metrics, conf.get("postprocessor", "metrics_file", fallback=None), 
+                conf.get("postprocessor", "stats_file", fallback=None), conf.getf("postprocessor", "metrics_interval", fallback=15))
+            metricswriter.start()
+        status_port = conf.geti("postprocessor", "status_port", fallback=0)
+        if status_port:
+            statusserver = jkm.status.StatusServer(status_report, status_port)
+            statusserver.start()
+        num_workers = conf.geti("postprocessor", "workers", fallback=1)
+        staged = conf.getb("postprocessor", "staged_pipeline", fallback=False)
+        worker_processes = not staged and (num_workers > 1 or conf.getb("postprocessor", "isolate_workers", fallback=False))
+        if conf.getb("postprocessor", "prefetch", fallback=False): # Read the next samples while the workers are busy
+            decode = conf.getb("postprocessor", "prefetch_decode", fallback=False)
+            if decode and worker_processes:
+                log.warning("prefetch_decode is ignored with worker processes: prefetching only warms the OS file cache for them")
+                decode = False
+            read = functools.partial(jkm.postprocessor.read_sample_files, conf, decode=decode)
+            prefetcher = jkm.prefetch.Prefetcher(q.get, read, conf.geti("postprocessor", "prefetch_samples", fallback=4), 
+                                                 conf.getf("postprocessor", "prefetch_mb", fallback=256)*2**20)
+            prefetcher.start()
          #Start loops looking for data to process and processing it
-        for i in range(_num_worker_threads):
-            t = threading.Thread(target=processSampleEvents,  args=(conf, sleep_s_before_reading_file, data_out_table))
+        if staged: # Threaded stages with bounded queues between them
+            log.info("Processing samples in a staged pipeline")
+            pipeline = build_pipeline(conf, data_out_table)
+            pipeline.start()
+            t = threading.Thread(target=feedPipeline,  args=(pipeline,))
+            t.start()
+            threads.append(t)
+        elif worker_processes: 
+            # Supervised worker processes, each with its own EAST net and barcode backend
+            log.info(f"Starting {num_workers} supervised worker processes")
+            mpcontext = multiprocessing.get_context("spawn") # Same behaviour on Windows and POSIX
+            logqueue = mpcontext.Queue()
+            loglistener = logging.handlers.QueueListener(logqueue, *log.handlers, respect_handler_level=True)
+            loglistener.start()
+            supervisor = build_supervisor(conf, data_out_table, num_workers, mpcontext, (conf.filename, logqueue, _program_name, _debug))
+            supervisor.start()
+            t = threading.Thread(target=dispatchSampleEvents,  args=(supervisor,))
             t.start()
-            threads.append(t)    
+            threads.append(t)
+        else:
+            for i in range(_num_worker_threads):
+                t = threading.Thread(target=processSampleEvents,  args=(conf, data_out_table))
+                t.start()
+                threads.append(t)    
+        if conf.getb("postprocessor", "process_existing"):
+            # Find file names matching a pattern and put them into the queue while the workers are already running
+            scanner = threading.Thread(target=queueExistingSamples,  args=(conf.basepath, datafile_patterns, conf.args.reprocess))
+            scanner.start()
         if not conf.getb( "postprocessor", "monitor"):
             log.debug("NOT MONITORING, JUST ONE PASSTHROUGH")
     #        q.join() # block until all tasks are done
         else:        
             log.debug("MONITORING DIRECTORY")
-            # Start a filesystem watchdog thread watching for NEW .metadata files
-            event_handler = myFileEventHandler(patterns=datafile_patterns) 
+            # Hand new samples to the workers once all their files are complete
+            detector = jkm.samplewatch.ReadinessDetector(enqueue, jkm.postprocessor.expected_sample_files(conf), settle_s, max_wait_s)
+            detector.start()
+            # Merge bursts of events into one per sample
+            per_directory = conf.get("sampleformat", "datatype_to_load").lower() != "singlefile"
+            coalescer = jkm.samplewatch.EventCoalescer(detector.add, datafile_patterns, 
+                                                       conf.getf("postprocessor", "event_window", fallback=2.0), per_directory)
+            coalescer.start()
+            # Start a filesystem watchdog thread watching for new and changed files
+            event_handler = myFileEventHandler(coalescer, detector) 
             observer = Observer()
             quit_if_not_exists(conf.basepath)
             observer.schedule(event_handler, str(conf.basepath), recursive=True)
@@ -258,17 +334,28 @@ if __name__ == '__main__':
             try: 
                 while True:
                     time.sleep(2)
-                    log.debug(f"Queue size is currently {q.qsize()}" )
+                    log.debug(f"Queue size is currently {q.depths()}" )
             except KeyboardInterrupt: # TODO: Add other end-of-life sources
                 observer.stop()
                 # Wait for other threads to stop 
             observer.join() # block until all tasks are done
+            _scan_stop.set()
+            coalescer.stop()
+            detector.stop()
 
+        if scanner: scanner.join() # In passthrough mode, the whole directory tree is queued before this returns
         log.info("Ending session, waiting for worker threads to finish.")    
-        for i in range(_num_worker_threads): q.put(None) # Signal end-of-life to worker threads
+        for t in threads: q.put(None) # Signal end-of-life to worker threads
         for t in threads: t.join()   # Wait for each worker thread to end properly
+        if pipeline: pipeline.close() # Wait for samples already in the pipeline
+        if supervisor: supervisor.shutdown() # Wait for samples already sent to worker processes
+        jkm.derivatives.close() # Write text area images etc. still queued
+        if loglistener: loglistener.stop()
+        if metricswriter: metricswriter.stop()
+        if statusserver: statusserver.stop()
         log.info("Ending session, closing log files.")
         if data_out_table: data_out_table.save()
+        ledger.close()
     except jkm.errors.JKError as msg:
         log.critical(f'Execution failed with error message "{msg}"')
         raise Exception(msg)